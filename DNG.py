@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from struct import unpack
+from struct import pack, unpack, unpack_from
 from os.path import splitext
+import mmap
 
 
 class Logging:
@@ -14,16 +15,25 @@ class Logging:
     def __init__(self):
         self.level = 0
 
-        def get_log_function(level):
-            def f(string):
-                if level >= self.level:
-                    self.log(string)
-            return f
+    # The message is only formatted with args if it is going to be shown
+    def critical(self, msg, *args):
+        self._log(self.CRITICAL, msg, args)
 
-        for levelname in ['critical', 'error', 'warning', 'info', 'debug']:
-            level = Logging.__dict__[levelname.upper()]
-            f = get_log_function(level)
-            setattr(self, levelname, f)
+    def error(self, msg, *args):
+        self._log(self.ERROR, msg, args)
+
+    def warning(self, msg, *args):
+        self._log(self.WARNING, msg, args)
+
+    def info(self, msg, *args):
+        self._log(self.INFO, msg, args)
+
+    def debug(self, msg, *args):
+        self._log(self.DEBUG, msg, args)
+
+    def _log(self, level, msg, args):
+        if level >= self.level:
+            self.log(msg % args if args else msg)
 
     def basicConfig(self, level):
         self.level = level
@@ -51,7 +61,10 @@ logging = Logging()
 logging.basicConfig(level=logging.INFO)
 
 
-class Tag:
+class Tag(object):
+
+    __slots__ = ('tag', 'type', 'count', 'value', 'file', 'offset',
+                 'value_is_checked')
 
     BYTE = 1
     ASCII = 2
@@ -91,12 +104,27 @@ class Tag:
 
     type_lengths = {BYTE: 1, ASCII: 1, SHORT: 2, LONG: 4,
                     RATIONAL: 8, UNDEFINED: 1}
+    # Method of the file that reads each type
+    read_functions = {BYTE: 'read_byte', ASCII: 'read_ascii',
+                      SHORT: 'read_short', LONG: 'read_long',
+                      RATIONAL: 'read_rational', UNDEFINED: 'read_ascii'}
 
     def tag_name(self):
+        return self.name_of(self.tag)
+
+    @classmethod
+    def name_of(cls, tag):
         try:
-            return self.tag_dict[self.tag]
+            return cls.tag_dict[tag]
         except:
-            return str(self.tag)
+            return str(tag)
+
+    @classmethod
+    def number_of(cls, name):
+        try:
+            return cls.tag_numbers[name]
+        except KeyError:
+            return int(name)  # Unknown tags are named after their number
 
     def __init__(self, tag, tag_type, count, value, file):
         self.tag = tag
@@ -104,19 +132,11 @@ class Tag:
         self.count = count
         self.value = value
         self.file = file
-        self.read_function = {
-            self.BYTE: file.read_byte,
-            self.ASCII: file.read_ascii,
-            self.SHORT: file.read_short,
-            self.LONG: file.read_long,
-            self.RATIONAL: file.read_rational,
-            self.UNDEFINED: file.read_ascii
-        }
+        self.value_is_checked = False
 
     def unsupported(self, c=0):
-        logging.debug(
-            "Unsupported type %d for tag %s" % (
-                self.type, self.tag_name()))
+        logging.debug("Unsupported type %d for tag %s", self.type,
+                      self.tag_name())
         raise NotImplementedError
 
     def read_value(self):
@@ -125,7 +145,7 @@ class Tag:
 
         self.file.seek(self.value)
 
-        readf = self.read_function[self.type]
+        readf = getattr(self.file, self.read_functions[self.type])
         self.offset = self.value
 
         try:
@@ -147,57 +167,75 @@ class Tag:
             value = self.value
         else:
             value = ":".join("{:02x}".format(ord(c)) for c in self.value)
-        return "Tag %s: %s" % (self.tag_name(self.tag), value)
+        return "Tag %s: %s" % (self.tag_name(), value)
 
 Tag.tag_dict = {number: tag_name for tag_name, number
                 in Tag.__dict__.iteritems()
                 if type(number) == int}
+Tag.tag_numbers = {tag_name: number for number, tag_name
+                   in Tag.tag_dict.iteritems()}
 
 
 class IFD(object):
+    """The entries are only decoded when a tag is asked for, so classifying
+    an image does not cost a Tag object for each of its entries"""
+
+    __slots__ = ('offset', 'dng', 'fields', 'positions', 'tag_list',
+                 'decoded', 'next')
+
     def __init__(self, dng, offset):
         dng.seek(offset)
         self.offset = offset
         self.dng = dng
         n_tags = dng.read_short()
-        self.entries = {}
-        self.entry_list = []
-
-        buf = dng.read(n_tags*12)
-        shortf = dng.shortf
-        longf = dng.longf
-        n = 0
-        SHORT = Tag.SHORT
-        BYTE = Tag.BYTE
-        ASCII = Tag.ASCII
-        while n < n_tags:
-            o = n*12
-            tag = unpack(shortf, buf[o:o+2])[0]
-            type = unpack(shortf, buf[o+2:o+4])[0]
-            count = unpack(longf, buf[o+4:o+8])[0]
-
-            if type == SHORT:
-                value = unpack(shortf, buf[o+8:o+10])[0]
-            elif type == BYTE:
-                value = buf[o+8]
-            elif type == ASCII and count <= 4:
-                value = buf[o+8:o+8+count]
-            else:
-                value = unpack(longf, buf[o+8:o+12])[0]
-
-            tag_obj = Tag(tag, type, count, value, dng)
-            tag_obj.value_is_checked = False
-            tag_name = tag_obj.tag_name()
-            self.entries[tag_name] = tag_obj
-            self.entry_list.append(tag_name)
-            n += 1
-
-        if self.entry_list[-1] == '0':
+        self.decoded = {}
+
+        # tag, type, count and value of every entry, in a single unpack. The
+        # value is read as a long, get_entry takes the short, byte or
+        # string out of it
+        self.fields = unpack_from(dng.shortf[0] + 'HHLL' * n_tags,
+                                  dng.read(n_tags*12))
+        self.tag_list = self.fields[::4]
+        # Tag number -> index of its entry in fields
+        self.positions = dict(zip(self.tag_list, xrange(0, n_tags*4, 4)))
+
+        if self.tag_list[-1] == 0:
             # At least the HTD diamond counts the next tag as one of the tags
             self.next = 0
         else:
             self.next = dng.read_long()
 
+    def get_entry(self, tag):
+        """The Tag object for the tag number. Raises KeyError if missing"""
+        try:
+            return self.decoded[tag]
+        except KeyError:
+            pass
+
+        i = self.positions[tag]
+        (tag, type, count, value) = self.fields[i:i+4]
+        if type in (Tag.SHORT, Tag.BYTE) or type == Tag.ASCII and count <= 4:
+            # The value is at the start of the field
+            big_endian = self.dng.shortf[0] == '>'
+            if type == Tag.SHORT:
+                value = value >> 16 if big_endian else value & 0xffff
+            else:
+                raw = pack(self.dng.longf, value)
+                value = raw[0] if type == Tag.BYTE else raw[:count]
+
+        tag_obj = Tag(tag, type, count, value, self.dng)
+        self.decoded[tag] = tag_obj
+        return tag_obj
+
+    @property
+    def entries(self):
+        return dict((Tag.name_of(tag), self.get_entry(tag))
+                    for tag in self.positions)
+
+    @property
+    def entry_list(self):
+        return [Tag.name_of(tag) for tag in self.tag_list]
+
     def __getattr__(self, attr):
         if attr == 'Width':
             return self.ImageWidth if hasattr(self, 'ImageWidth') else -1
@@ -216,7 +254,7 @@ class IFD(object):
             return s
 
         try:
-            entry = self.entries[attr]
+            entry = self.get_entry(Tag.number_of(attr))
         except:
             raise AttributeError
 
@@ -227,7 +265,7 @@ class IFD(object):
                 entry.read_value()
                 entry.value_is_checked = True
             except:
-                logging.debug("Unable to read value for tag %s" % attr)
+                logging.debug("Unable to read value for tag %s", attr)
                 raise NotImplementedError
             return entry.value
 
@@ -241,8 +279,9 @@ class IFD(object):
 
     def dump(self):
         res = "Offset: %d -> Next: %d\n" % (self.offset, self.next)
-        for entry in self.entry_list:
-            tag = self.entries[entry]
+        for tag_number in self.tag_list:
+            entry = Tag.name_of(tag_number)
+            tag = self.get_entry(tag_number)
             try:
                 value = str(getattr(self, entry))
                 if tag.type == tag.UNDEFINED:
@@ -257,7 +296,7 @@ class IFD(object):
 
 class DNG:
     def wrong_format(self):
-        logging.error("Invalid file format in file %s" % self.f.name)
+        logging.error("Invalid file format in file %s", self.f.name)
         raise IOError
 
     def set_endian(self, endian):
@@ -274,30 +313,73 @@ class DNG:
     def fileno(self):
         return self.f.fileno()
 
+    # The first HEADER_WINDOW bytes are read at once when the file is opened
+    # and the tiff structure is decoded from that buffer. Reads beyond it are
+    # done in aligned blocks that are kept, so that neighbouring values cost
+    # a single read
+    HEADER_WINDOW = 256 * 1024
+    BLOCK = 64 * 1024
+    MAX_BLOCKS = 16
+
     def seek(self, offset):
-        self.f.seek(self.offset + offset)
+        self.pos = offset
 
     def read(self, count):
-        return self.f.read(count)
+        pos = self.pos
+        self.pos += count
+        if pos + count <= len(self.buf):
+            return self.buf[pos:pos+count]
+        return self.read_outside(pos, count)
+
+    def read_outside(self, pos, count):
+        if count > self.BLOCK:
+            # Large payloads, like the previews, are not worth keeping
+            self.f.seek(self.offset + pos)
+            return self.f.read(count)
+
+        first = pos // self.BLOCK
+        last = (pos + count - 1) // self.BLOCK
+        data = "".join(self.read_block(n) for n in range(first, last + 1))
+        start = pos - first * self.BLOCK
+        return data[start:start+count]
+
+    def read_block(self, n):
+        try:
+            return self.blocks[n]
+        except KeyError:
+            pass
+        if len(self.blocks) >= self.MAX_BLOCKS:
+            self.blocks.clear()
+        self.f.seek(self.offset + n * self.BLOCK)
+        block = self.blocks[n] = self.f.read(self.BLOCK)
+        return block
+
+    def unpack(self, fmt, size):
+        pos = self.pos
+        self.pos += size
+        if pos + size <= len(self.buf):
+            return unpack_from(fmt, self.buf, pos)[0]
+        return unpack(fmt, self.read_outside(pos, size))[0]
 
     def read_byte(self, c=0):
-        return ord(self.f.read(1))
+        return ord(self.read(1))
 
     def read_ascii(self, count):
-        return self.f.read(count)[:-1]
+        return self.read(count)[:-1]
 
     def read_short(self, c=0):
-        return unpack(self.shortf, self.f.read(2))[0]
+        return self.unpack(self.shortf, 2)
 
     def read_long(self, c=0):
-        return unpack(self.longf, self.f.read(4))[0]
+        return self.unpack(self.longf, 4)
 
     def read_rational(self, c=0):
-        return float(unpack(self.longf, self.f.read(4))[0]) \
-            / unpack(self.longf, self.f.read(4))[0]
+        return float(self.read_long()) / self.read_long()
 
-    def __init__(self, path='', offset=0, exif=False):
+    def __init__(self, path='', offset=0, exif=False, window=None):
         self.exif = exif  # If True we are opening the exif IFD from a JPEG
+        if window is not None:
+            self.HEADER_WINDOW = window
 
         if path:
             self.open(path, offset)
@@ -317,12 +399,17 @@ class DNG:
         self.f = open(source, "rb")
         self.offset = offset
         self.f.seek(offset)
+        self.buf = self.f.read(self.HEADER_WINDOW)
+        self.blocks = {}
+        self.pos = 0
+        return self.read_header()
 
-        endian = self.f.read(2)
+    def read_header(self):
+        endian = self.read(2)
         self.set_endian(endian)
         magic = self.read_short()
         if magic not in (42, 85):  # Tiff/DNG, RW2
-            logging.error("Unrecognized magic number %d" % magic)
+            logging.error("Unrecognized magic number %d", magic)
             self.wrong_format()
 
         self.first_ifdo = self.read_long()
@@ -331,6 +418,7 @@ class DNG:
     def close(self):
         self.f.close()
         del self.f
+        self.buf = self.blocks = None
 
     def __del__(self):
         try:
@@ -344,37 +432,44 @@ class DNG:
     def get_first_image(self):
         return self.get_image(self.first_ifdo)
 
-    def get_images(self):
-        res = []
+    def iter_images(self, follow_exif=True):
+        """Yields the IFDs as they are parsed. The exif IFDs hold no images,
+        so they can be skipped when looking for previews"""
         ifdo_list = [self.first_ifdo]
+        seen = set()
         while len(ifdo_list):
 
             ifdo = ifdo_list.pop(0)
-            if not ifdo:
-                break
+            if not ifdo or ifdo in seen:
+                continue
+            seen.add(ifdo)
             try:
                 ifd = IFD(self, ifdo)
-                res.append(ifd)
-
-                def append_ifd(list, tag):
-                    # It can either be a tag or a list of tags
-                    try:
-                        list = tag + list
-                    except TypeError:
-                        list = [tag] + list
-                    return list
+            except:
+                continue
+            yield ifd
 
+            def append_ifd(list, tag):
+                # It can either be a tag or a list of tags
                 try:
-                    ifdo_list = append_ifd(ifdo_list, ifd.SubIFD)
-                except:
-                    pass
+                    list = tag + list
+                except TypeError:
+                    list = [tag] + list
+                return list
+
+            try:
+                ifdo_list = append_ifd(ifdo_list, ifd.SubIFD)
+            except:
+                pass
+            if follow_exif:
                 try:
                     ifdo_list = append_ifd(ifdo_list, ifd.ExifTag)
                 except:
                     pass
-            except:
-                pass
             ifd.next and ifdo_list.append(ifd.next)
+
+    def get_images(self):
+        res = list(self.iter_images())
         try:
             res.sort(cmp=lambda x, y: cmp(x.ImageWidth*x.ImageLength,
                                           y.ImageWidth*y.ImageLength))
@@ -388,23 +483,61 @@ class DNG:
                 if self.exif
                 or hasattr(i, 'SubFileType') and i.SubFileType == 1]
 
+    def iter_jpeg_previews(self):
+        """Yields the jpeg previews in file order"""
+        for i in self.iter_images(follow_exif=False):
+            if (self.exif or hasattr(i, 'SubFileType')
+                    and i.SubFileType == 1) \
+                    and hasattr(i, 'Compression') \
+                    and i.Compression in (7, 6):
+                yield i
+                if self.exif:
+                    return  # The exif thumbnail is the only one
+
     def get_jpeg_previews(self):
-        return [i for i in self.get_previews()
-                if hasattr(i, 'Compression') and i.Compression in (7, 6)]
+        """The jpeg previews from the smallest to the largest"""
+        return sorted(self.iter_jpeg_previews(),
+                      key=lambda i: i.Width*i.Length)
 
-    def read_jpeg_preview(self, index=0):
+    def get_jpeg_extent(self, index=0):
+        """Returns (offset, length) of the jpeg preview, relative to the
+        start of the file and not to the tiff header"""
         try:
-            jpg = self.get_jpeg_previews()[index]
-            if hasattr(jpg, 'StripOffsets') and hasattr(jpg, 'StripByteCounts'):
-                self.seek(jpg.StripOffsets)
-                return self.read(jpg.StripByteCounts)
-            elif hasattr(jpg, 'JPEGInterchangeFormat') \
-                    and hasattr(jpg, 'JPEGInterchangeFormatLength'):
-                self.seek(jpg.JPEGInterchangeFormat)
-                return self.read(jpg.JPEGInterchangeFormatLength)
-        except KeyError:
-            logging.error("No jpeg preview in %s" % self.f.name)
-            raise IOError
+            if index in (0, -1):
+                # Just the smallest or the largest, no need to sort them
+                jpg = None
+                for i in self.iter_jpeg_previews():
+                    pixels = i.Width*i.Length
+                    if jpg is None or (pixels >= best if index == -1
+                                       else pixels < best):
+                        (jpg, best) = (i, pixels)
+                if jpg is None:
+                    raise IndexError
+            else:
+                jpg = self.get_jpeg_previews()[index]
+            extent = self.extent_of(jpg)
+            if extent:
+                return extent
+        except (KeyError, IndexError):
+            pass
+        logging.error("No jpeg preview in %s", self.f.name)
+        raise IOError
+
+    def extent_of(self, jpg):
+        """(offset, length) of the jpeg stored in the IFD jpg, relative to the
+        start of the file, or None if the IFD does not say"""
+        if hasattr(jpg, 'StripOffsets') and hasattr(jpg, 'StripByteCounts'):
+            return (self.offset + jpg.StripOffsets, jpg.StripByteCounts)
+        elif hasattr(jpg, 'JPEGInterchangeFormat') \
+                and hasattr(jpg, 'JPEGInterchangeFormatLength'):
+            return (self.offset + jpg.JPEGInterchangeFormat,
+                    jpg.JPEGInterchangeFormatLength)
+        return None
+
+    def read_jpeg_preview(self, index=0):
+        (offset, length) = self.get_jpeg_extent(index)
+        self.seek(offset - self.offset)
+        return self.read(length)
 
     def dump(self):
         for i in self.get_images():
@@ -420,46 +553,112 @@ class DNG:
             raise AttributeError
 
 
-def JPG(path, offset=0):
+class MappedDNG(DNG):
+    """DNG reading through a memory map of the file. The whole file is the
+    header window, and large reads return buffers over the map instead of
+    copies, so a preview can be written out without holding it in memory"""
+
+    def open(self, source, offset=0):
+        try:
+            self.close()
+        except:
+            pass
+
+        self.f = open(source, "rb")
+        self.offset = offset
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, prot=mmap.PROT_READ)
+        except ValueError:
+            self.wrong_format()  # Empty file
+        self.buf = buffer(self.mm, offset)
+        self.blocks = {}
+        self.pos = 0
+        return self.read_header()
+
+    def read(self, count):
+        if count <= self.BLOCK:
+            return DNG.read(self, count)
+        pos = self.pos
+        self.pos += count
+        return buffer(self.mm, self.offset + pos, count)
+
+    def close(self):
+        # Buffers handed out keep the map alive, so it is not closed here
+        DNG.close(self)
+        self.mm = None
+
+
+def JPG(path, offset=0, backend=DNG):
     # TODO would be a lot better to parse jpg applications
     try:
-        dng = DNG(path, offset=offset+12, exif=True)
+        dng = backend(path, offset=offset+12, exif=True)
     except:
-        dng = DNG(path, offset=offset+30, exif=True)
+        dng = backend(path, offset=offset+30, exif=True)
     return dng
 
 
+def read_extent(path, offset, length, mapped=False):
+    """Reads length bytes at offset of path without parsing anything"""
+    with open(path, "rb") as f:
+        if mapped:
+            mm = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+            return buffer(mm, offset, length)
+        f.seek(offset)
+        return f.read(length)
+
+
 class Preview:
-    def __init__(self, path=''):
+    """The jpeg previews of a raw file.
+
+    layout is what a previous Preview.layout() returned for the same file.
+    With it the previews are read straight from their extents and the
+    headers are only parsed if something else is asked"""
 
+    def __init__(self, path='', mapped=False, layout=None):
+        self.path = path
+        self.mapped = mapped
+        self.known_layout = layout
+        if layout is None:
+            self.img = self.open_image()
+
+    def open_image(self):
+        path = self.path
         ext = splitext(path)[1].lower()
+        backend = MappedDNG if self.mapped else DNG
+        self.preview_image = None
 
         if ext == '.dng':
-            img = DNG(path)
+            img = backend(path)
         elif ext in ['.jpg', '.jpeg']:
-            img = JPG(path)
+            img = JPG(path, backend=backend)
         elif ext == ".rw2":
-            with DNG(path) as img:
-                ifd = img.get_first_image()
-                # TODO This is not elegant. The caller should not need to know
-                # about the entries dictionary
-                try:
-                    offset = ifd.entries['PreviewImage'].offset
-                except:
-                    # read_value hasn't been called yet and so the offset
-                    # property is not present
-                    offset = ifd.entries['PreviewImage'].value
-            img = JPG(path, offset=offset)
+            if self.known_layout:
+                offset = self.known_layout['preview_image']
+            else:
+                with DNG(path) as img:
+                    ifd = img.get_first_image()
+                    # TODO This is not elegant. The caller should not need to
+                    # know about the tag entries
+                    entry = ifd.get_entry(Tag.PreviewImage)
+                    try:
+                        offset = entry.offset
+                    except:
+                        # read_value hasn't been called yet and so the offset
+                        # property is not present
+                        offset = entry.value
+            self.preview_image = offset
+            img = JPG(path, offset=offset, backend=backend)
         else:
             raise NotImplementedError('Unknown extension %s' % ext)
 
-        self.img = img
+        return img
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.img.close()
+        if 'img' in self.__dict__:
+            self.img.close()
 
     def list(self):
         for ifd in self.get_jpeg_previews():
@@ -471,11 +670,48 @@ class Preview:
     def get_jpeg_previews(self):
         return self.img.get_jpeg_previews()
 
+    def get_jpeg_extent(self, index=0):
+        if self.known_layout:
+            try:
+                return tuple(self.known_layout['previews'][index][:2])
+            except IndexError:
+                raise IOError
+        return self.img.get_jpeg_extent(index)
+
     def read_jpeg_preview(self, index=0):
+        if self.known_layout:
+            (offset, length) = self.get_jpeg_extent(index)
+            return read_extent(self.path, offset, length, self.mapped)
         return self.img.read_jpeg_preview(index)
 
+    def layout(self):
+        """Everything needed to serve the previews without parsing the file
+        again, as a json friendly dict: the [offset, length, width, length,
+        compression] of each preview from the smallest to the largest, the
+        orientation and the offset of the PreviewImage of rw2 files"""
+        if self.known_layout:
+            return self.known_layout
+        previews = []
+        for ifd in self.img.get_jpeg_previews():
+            extent = self.img.extent_of(ifd)
+            if extent:
+                previews.append(list(extent) +
+                                [ifd.Width, ifd.Length, ifd.Compression])
+        if not previews:
+            logging.error("No jpeg preview in %s", self.path)
+            raise IOError
+        return {'previews': previews,
+                'orientation': self.img.Orientation,
+                'preview_image': self.preview_image}
+
     def __getattr__(self, attr):
-        if attr == 'Orientation':
+        if attr == 'img':
+            # Only parsed when the layout was not enough
+            self.img = self.open_image()
+            return self.img
+        elif attr == 'Orientation':
+            if self.known_layout:
+                return self.known_layout['orientation']
             return self.img.Orientation
         else:
             raise AttributeError
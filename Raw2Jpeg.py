@@ -4,63 +4,108 @@
 from __future__ import with_statement
 
 import os
-from os.path import join
+from os.path import join, dirname, basename
+from stat import S_ISDIR, S_IFDIR, S_IFREG
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 import sys
 import errno
 import logging
-import json
+import time
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+from functools import partial
 
 from loop import Passthrough
-from fuse import FUSE, FuseOSError
-
-from previewcache import get_thumbdir, get_preview, set_thumbdir
-
-set_thumbdir('/srv/tmp/.raw2jpg')
+from fuse import FUSE, FuseOSError, fuse_file_info
+
+import previewcache
+from previewcache import get_preview, get_extent, get_preview_size, \
+    set_thumbdir, set_cache_size, set_build_workers, preview_path, \
+    is_built, build_preview, read_layout, add_preview, BuildPoolBusy
+from prefetch import Prefetcher
+from attrcache import AttrCache
+from syscalls import pread, pwrite
+from tracing import Tracer
+from stats import stats
+import DNG
+
+THUMBDIR = '/srv/tmp/.raw2jpg'  # Preview cache of the mount
 # logging.basicConfig(filename="/srv/tmp/raw2jpeg.log",level=logging.DEBUG)
-logging.basicConfig(level=logging.DEBUG)
-
-
-class Blacklist():
-    def __init__(self):
-        self.bl = {}
-        try:
-            self.blfile = open(get_thumbdir()+"/blacklist.txt", "r+")
-        except:
-            self.blfile = open(get_thumbdir()+"/blacklist.txt", "w")
-        try:
-            self.bl = json.loads(self.blfile.read())
-        except:
-            logging.warning("Error cargando blacklist")
-            pass
-
-    def _save(self):
-        self.blfile.seek(0)
-        self.blfile.truncate()
-        self.blfile.write(json.dumps(self.bl))
-        self.blfile.flush()
-
-    def add(self, path):
-        logging.debug("Blacklisting %s" % path)
-        self.bl[path] = os.path.getmtime(path)
-        self._save()
-
-    def match(self, path):
-        if path in self.bl and os.path.getmtime(path) == self.bl[path]:
-            return True
-        elif path in self.bl:
-            self.bl.pop(path)
-            self._save()
-        return False
 
 
 class Raw2Jpeg(Passthrough):
 
     MASK = ".maskedraw.jpg"
+    # Named sizes of the variants, the others are a number of pixels. Each
+    # variant of IMG.dng is listed as IMG.dng.<name>.jpg besides the masked
+    # name, and shows the smallest preview whose longest side is that large
+    VARIANTS = {'thumb': 0, 'full': None}
+    STAT_KEYS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
+                 'st_nlink', 'st_size', 'st_uid')
     EXTS = ('.dng', '.rw2')
     FNULL = open(os.devnull, 'w')  # Se usa para redirigir a /dev/null
+    # Only one in this many calls of the busiest operations is kept in the
+    # trace. All of them are timed
+    TRACE_SAMPLE = {'read': 100, 'read_buf': 100, 'getattr': 10}
+    # Read only files with the statistics of the mount, and the Stats method
+    # that renders each one. Their directory hides any in the original tree
+    STATS_DIR = "/.raw2jpeg"
+    STATS_FILES = {'stats.json': 'json', 'stats.prom': 'prometheus'}
+    # Masked files whose original identity is remembered. The kernel drops
+    # the cached pages of the least recently opened ones
+    SERVED_SIZE = 10000
 
     # Paths that failed to create a thumbnail. Do not list them
-    blacklist = Blacklist()
+    @property
+    def blacklist(self):
+        return previewcache.blacklist
+
+    def __init__(self, root, extents=False, prefetch=0, prefetch_queue=500,
+                 attr_cache=0, cache_size=0, variants=()):
+        super(Raw2Jpeg, self).__init__(root)
+        # (suffix, preview size) of the names given to each raw file
+        self.suffixes = [(self.MASK, None)] + \
+            [(".%s.jpg" % v, self.VARIANTS[v] if v in self.VARIANTS
+              else int(v)) for v in variants]
+        self.cache_size = cache_size  # Bytes, no limit if 0
+        # In extent mode masked files are served straight from the original
+        # raw file, and the cache only keeps where the preview is
+        self.extents = extents
+        self.open_extents = {}  # fh -> (offset, length) of the preview
+        self.snapshots = {}  # fh -> contents of an open stats file
+        # Identity of the original each masked file was last served from.
+        # While it does not change the kernel may keep the cached pages
+        self.served = OrderedDict()
+        self.served_lock = threading.Lock()
+
+        # Workers building the previews of listed directories in advance
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = Prefetcher(
+                get_extent if extents else get_preview,
+                workers=prefetch, max_queue=prefetch_queue)
+
+        # Attributes and listings kept in memory until the source changes
+        self.attrcache = AttrCache(attr_cache) if attr_cache else None
+
+        self.tracer = Tracer(sample=self.TRACE_SAMPLE)
+
+    def __call__(self, op, *args):
+        # readdir returns a generator, so only its creation is timed
+        if not hasattr(self, op):
+            raise FuseOSError(errno.EFAULT)
+        stats.gauge('operations_in_flight', 1)
+        try:
+            return self.tracer.run(op, getattr(self, op), args)
+        finally:
+            stats.gauge('operations_in_flight', -1)
 
     # Helpers
     # =======
@@ -69,17 +114,89 @@ class Raw2Jpeg(Passthrough):
         """Devuelve el nombre falso"""
         return path+self.MASK if path[-4:].lower() in self.EXTS else path
 
+    def _names(self, name):
+        """The names listed for the file name, one per variant of raw
+        files"""
+        if name[-4:].lower() not in self.EXTS:
+            return [name]
+        return [name + suffix for (suffix, size) in self.suffixes]
+
+    def _variant(self, path):
+        """(original, preview size) of a masked path, or None"""
+        for (suffix, size) in self.suffixes:
+            if path.endswith(suffix):
+                orig = path[:-len(suffix)]
+                if orig[-4:].lower() in self.EXTS:
+                    return (orig, size)
+        return None
+
     def _original(self, path):
         """Devuelve el archivo original"""
-        return path[:-14] if path[-14:] == self.MASK else path
+        variant = self._variant(path)
+        return variant[0] if variant else path
 
     def _ismasked(self, path):
-        return path[-14:] == self.MASK
+        return self._variant(path) is not None
+
+    def _isstats(self, path):
+        return path == self.STATS_DIR or dirname(path) == self.STATS_DIR
+
+    def _stats(self, name):
+        """Contents of the stats file name"""
+        try:
+            render = getattr(stats, self.STATS_FILES[name])
+        except KeyError:
+            raise FuseOSError(errno.ENOENT)
+        return render(self.tracer.stats())
+
+    def _stats_attrs(self, path):
+        now = time.time()
+        res = {'st_atime': now, 'st_ctime': now, 'st_mtime': now,
+               'st_uid': os.getuid(), 'st_gid': os.getgid()}
+        if path == self.STATS_DIR:
+            res.update(st_mode=S_IFDIR | 0555, st_nlink=2, st_size=0)
+        else:
+            res.update(st_mode=S_IFREG | 0444, st_nlink=1,
+                       st_size=len(self._stats(basename(path))))
+        return res
+
+    @staticmethod
+    def _fh(fh):
+        """The file handle, also when FUSE passes the fuse_file_info"""
+        return fh.fh if isinstance(fh, fuse_file_info) else fh
+
+    def _unchanged(self, path, orig):
+        """True if orig is the same file it was the last time path was
+        opened, so what the kernel cached for path is still valid"""
+        st = os.stat(orig)
+        identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        with self.served_lock:
+            previous = self.served.pop(path, None)
+            self.served[path] = identity  # Most recently opened goes last
+            if len(self.served) > self.SERVED_SIZE:
+                self.served.popitem(last=False)
+        return previous == identity
 
     # Filesystem methods
     # ==================
 
+    def init(self, path):
+        if self.prefetcher:
+            self.prefetcher.start()
+        if self.attrcache:
+            self.attrcache.start()
+        if self.cache_size:
+            set_cache_size(self.cache_size)
+
+    def destroy(self, path):
+        if self.prefetcher:
+            self.prefetcher.cancel()
+
     def access(self, path, mode):
+        if self._isstats(path):
+            if mode & os.W_OK:
+                raise FuseOSError(errno.EACCES)
+            return
         full_path = self._full_path(path)
         if not os.access(full_path, mode):
             raise FuseOSError(errno.EACCES)
@@ -93,37 +210,119 @@ class Raw2Jpeg(Passthrough):
         return os.chown(full_path, uid, gid)
 
     def getattr(self, path, fh=None):
-        logging.debug("getattr %s %s" % (path, fh))
-        # TODO olvidarnos de la subclase de loop
-        res = super(Raw2Jpeg, self).getattr(self._original(path), fh)
+        if self._isstats(path):
+            return self._stats_attrs(path)
+        if self.attrcache:
+            res = self.attrcache.get(('attr', path))
+            if res:
+                return res
+
         full_path = self._full_path(path)
-        if self._ismasked(path):
-            orig = self._original(full_path)
+        st = os.lstat(self._original(full_path))
+        return self._attrs(path, full_path, st)
+
+    def _attrs(self, path, full_path, st):
+        """getattr result for path given the stat of its original file"""
+        res = dict((key, getattr(st, key)) for key in self.STAT_KEYS)
+        variant = self._variant(full_path)
+        if variant:
+            (orig, size) = variant
             try:
-                size = getattr(os.lstat(get_preview(orig)), 'st_size')
-                res['st_size'] = size
+                if self.extents:
+                    res['st_size'] = get_extent(orig, size)[1]
+                else:
+                    # The preview is only built when the file is opened
+                    res['st_size'] = get_preview_size(orig, size)
+            except BuildPoolBusy:
+                return res  # Not cached, the size is asked for again
             except:
-                self.blacklist.add(self._original(full_path))
+                if not self.blacklist.match(orig):
+                    self.blacklist.add(orig)
+                if self.attrcache:
+                    # So that the next listing leaves it out
+                    self.attrcache.drop(('dir', dirname(path)))
+                return res
+        if self.attrcache:
+            self.attrcache.set(('attr', path), self._original(full_path),
+                               res['st_mtime'], res)
         return res
-        # full_path = self._full_path(path)
-        # st = os.lstat(full_path)
-        # return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-        #             'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
 
     def readdir(self, path, fh):
-        logging.debug("readdir %s %s" % (path, fh))
+        """Yields the attributes along with the names, so that the kernel
+        does not need to call getattr for each entry"""
+        if path == self.STATS_DIR:
+            yield '.'
+            yield '..'
+            for name in sorted(self.STATS_FILES):
+                yield (name, self._stats_attrs(join(path, name)), 0)
+            return
+
         full_path = self._full_path(path)
 
-        dirents = ['.', '..']
-        if os.path.isdir(full_path):
-            # logging.debug("Blacklist %s\nFiles %s" % (
-            #               self.blacklist.bl, [full_path+'/'+self._masked(f)
-            #                                   for f in os.listdir(full_path)]))
-            ld = [self._masked(f) for f in os.listdir(full_path)
-                  if not self.blacklist.match(join(full_path, f))]
-            dirents.extend(ld)
-        for r in dirents:
-            yield r
+        files = self.attrcache and self.attrcache.get(('dir', path))
+        if files is None:
+            entries = self._listdir(path, full_path)
+        else:
+            entries = [(f, None) for f in files]
+
+        if self.prefetcher and entries:
+            self.prefetcher.prefetch(
+                full_path, [join(full_path, f) for f, st in entries
+                            if f[-4:].lower() in self.EXTS])
+
+        yield '.'
+        yield '..'
+        if path == '/':
+            yield (basename(self.STATS_DIR),
+                   self._stats_attrs(self.STATS_DIR), 0)
+        for f, st in entries:
+            for name in self._names(f):
+                entry_path = join(path, name)
+                attrs = self.attrcache and self.attrcache.get(
+                    ('attr', entry_path))
+                try:
+                    if not attrs:
+                        st = st or os.lstat(join(full_path, f))
+                        attrs = self._attrs(entry_path,
+                                            join(full_path, name), st)
+                except OSError:
+                    break  # Removed since it was listed
+                yield (name, attrs, 0)
+
+    def _listdir(self, path, full_path):
+        """(name, stat) of the files in the directory, without the
+        blacklisted ones"""
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return []
+        if not S_ISDIR(st.st_mode):
+            return []
+
+        entries = []
+        for f, f_st in self._scandir(full_path):
+            if not self.blacklist.match(join(full_path, f),
+                                        origmtime=f_st.st_mtime):
+                entries.append((f, f_st))
+        if self.attrcache:
+            self.attrcache.set(('dir', path), full_path, st.st_mtime,
+                               [f for f, f_st in entries], isdir=True)
+        return entries
+
+    @staticmethod
+    def _scandir(full_path):
+        if scandir:
+            for entry in scandir(full_path):
+                try:
+                    yield (entry.name, entry.stat(follow_symlinks=False))
+                except OSError:
+                    pass  # Removed while listing
+        else:
+            for f in os.listdir(full_path):
+                try:
+                    yield (f, os.lstat(join(full_path, f)))
+                except OSError:
+                    pass
 
     def readlink(self, path):
         pathname = os.readlink(self._full_path(path))
@@ -170,53 +369,303 @@ class Raw2Jpeg(Passthrough):
     # ============
 
     def open(self, path, flags):
-        logging.debug("open %s %s" % (self._full_path(path), flags))
+        """flags is the fuse_file_info when mounted with raw_fi. Then the
+        kernel is told to keep the cached pages of a preview while its
+        original does not change"""
+        fi = flags if isinstance(flags, fuse_file_info) else None
+        if fi:
+            flags = fi.flags
         full_path = self._full_path(path)
-        if self._ismasked(full_path):
-                full_path = get_preview(self._original(full_path))
-        return os.open(full_path, flags)
+        variant = self._variant(full_path)
+        keep_cache = False
+        direct_io = False
+        if self._isstats(path):
+            # The contents are taken now, and their size may differ from
+            # what getattr said, so the kernel must not cache them
+            data = self._stats(basename(path))
+            fh = os.open(os.devnull, os.O_RDONLY)
+            self.snapshots[fh] = data
+            direct_io = True
+        elif variant and self.extents:
+            (orig, size) = variant
+            (offset, length, orientation) = get_extent(orig, size)
+            keep_cache = self._unchanged(path, orig)
+            fh = os.open(orig, flags)
+            self.open_extents[fh] = (offset, length)
+        elif variant:
+            (orig, size) = variant
+            full_path = get_preview(orig, size)
+            keep_cache = self._unchanged(path, orig)
+            fh = os.open(full_path, flags)
+            self.open_extents[fh] = (0, os.fstat(fh).st_size)
+        else:
+            fh = os.open(full_path, flags)
+
+        if not fi:
+            return fh
+        fi.fh = fh
+        fi.keep_cache = keep_cache
+        fi.direct_io = direct_io
+        return 0
 
     def create(self, path, mode, fi=None):
         full_path = self._full_path(path)
-        logging.debug("create %s %s %s" % (full_path, mode, fi))
         return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
 
     def read(self, path, length, offset, fh):
-        logging.debug("read %s %s %s %s" % (path, length, offset, fh))
-        try:
-            os.lseek(fh, offset, os.SEEK_SET)
-        except:
-            logging.warning("failed lseek")
-        data = os.read(fh, length)
+        fh = self._fh(fh)
+        if fh in self.snapshots:
+            return self.snapshots[fh][offset:offset+length]
+        if fh in self.open_extents:
+            (start, size) = self.open_extents[fh]
+            length = max(0, min(length, size - offset))
+            data = pread(fh, length, start + offset)
+        else:
+            data = pread(fh, length, offset)
+        stats.add('bytes_read', len(data))
         return data
 
+    def read_buf(self, path, length, offset, fh):
+        """Like read, but only says where the data is. libfuse reads it from
+        the file descriptor, so it does not go through python"""
+        fh = self._fh(fh)
+        if fh in self.snapshots:
+            return self.snapshots[fh][offset:offset+length]
+        if fh in self.open_extents:
+            (start, size) = self.open_extents[fh]
+            length = max(0, min(length, size - offset))
+            offset += start
+        stats.add('bytes_read', length)
+        return (fh, offset, length)
+
     def write(self, path, buf, offset, fh):
-        logging.debug("write %s %s %s %s" % (path, buf, offset, fh))
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        fh = self._fh(fh)
+        return pwrite(fh, buf, offset)
 
     def truncate(self, path, length, fh=None):
-        logging.debug("truncate %s %s %s" % (path, length, fh))
         full_path = self._full_path(path)
         with open(full_path, 'r+') as f:
             f.truncate(length)
 
     def flush(self, path, fh):
-        logging.debug("flush %s %s" % (path, fh))
+        fh = self._fh(fh)
+        if fh in self.snapshots:
+            return  # /dev/null can not be synced
         return os.fsync(fh)
 
     def release(self, path, fh):
-        logging.debug("release %s %s" % (path, fh))
+        fh = self._fh(fh)
+        self.open_extents.pop(fh, None)
+        self.snapshots.pop(fh, None)
         return os.close(fh)
 
     def fsync(self, path, fdatasync, fh):
-        logging.debug("fsync %s %s %s" % (path, fdatasync, fh))
         return self.flush(path, fh)
 
 
-def main(mountpoint, root):
-    FUSE(Raw2Jpeg(root), mountpoint, foreground=True,
-         ro=True, allow_other=True)
+def _prewarm_file(origpath, sizes=(None, 0)):
+    """Builds the previews of a file in each of sizes. Runs in the prewarm
+    workers, which leave the orientations, the layouts and the blacklist to
+    the parent process"""
+    built = []
+    layout = None
+    try:
+        st = os.stat(origpath)
+        for size in sizes:
+            preview = preview_path(origpath, size, st)
+            if is_built(preview):
+                continue
+            layout = layout or read_layout(origpath, st)
+            (preview, orientation) = build_preview(origpath, preview,
+                                                   size, layout)
+            built.append((size, preview, orientation,
+                          os.path.getsize(preview)))
+    except Exception as e:
+        return (origpath, built, layout, str(e) or e.__class__.__name__)
+    return (origpath, built, layout, None)
+
+
+def prewarm(root, jobs=None, sizes=(None, 0)):
+    """Builds the previews of every raw file under root using all the cores,
+    so that a new mount does not have to build them on first access"""
+    blacklist = previewcache.blacklist
+    layouts = previewcache.layouts
+
+    def raw_files():
+        for dirpath, dirnames, filenames in os.walk(root):
+            for f in filenames:
+                path = join(dirpath, f)
+                if f[-4:].lower() in Raw2Jpeg.EXTS \
+                        and not blacklist.match(path):
+                    yield path
+
+    def report(final=False):
+        # Not zero, when the tree is empty or was already built
+        elapsed = max(time.time() - start, 0.001)
+        logging.info("%s%d files, %d built, %d failed, %.1f files/s, "
+                     "%.1f MB/s", "Done: " if final else "",
+                     files, built, failures,
+                     files / elapsed, nbytes / elapsed / 2**20)
+
+    pool = Pool(jobs)
+    start = last_report = time.time()
+    files = built = failures = nbytes = 0
+    try:
+        for origpath, previews, layout, error in pool.imap_unordered(
+                partial(_prewarm_file, sizes=sizes), raw_files(),
+                chunksize=8):
+            files += 1
+            if layout:
+                layouts.set(origpath, layout)
+            for size, preview, orientation, length in previews:
+                add_preview(origpath, size, preview, orientation)
+                built += 1
+                nbytes += length
+            if error:
+                logging.warning("Failed %s: %s", origpath, error)
+                failures += 1
+                blacklist.add(origpath)
+            if time.time() - last_report > 10:
+                last_report = time.time()
+                report()
+    finally:
+        pool.terminate()
+        pool.join()
+    report(final=True)
+
+
+def main(mountpoint, root, extents=False, prefetch=0, prefetch_queue=500,
+         attr_cache=0, cache_size=0, timeout=10.0, single_thread=False,
+         build_workers=0, build_timeout=30, record=None, variants=()):
+    """Mounts root on mountpoint.
+
+    libfuse calls the operations from several threads unless single_thread
+    is set. Reads use pread on the shared file handles and the caches lock
+    their own state, so clients streaming previews at the same time are
+    served in parallel. The GIL is only released in the system calls, like
+    pread, and while waiting for another thread or a build worker. Parsing
+    a raw file and building its preview in process hold it, so slow builds
+    are better left to build_workers.
+
+    raw_fi lets open keep the page cache of unchanged previews. timeout is
+    how long the kernel trusts names and attributes without asking again.
+
+    With build_workers the previews are built in that many processes, and a
+    file that takes longer than build_timeout seconds to parse and extract
+    is blacklisted. The headers read for getattr and listings are parsed
+    in those processes too. If no process is free in that time an open
+    fails, and getattr gives the size of the original file.
+
+    variants are the names of the Raw2Jpeg.VARIANTS, or numbers of pixels,
+    of the extra previews listed for each raw file.
+
+    Sending SIGUSR1 writes the latency of each operation and the last
+    calls to trace.txt in the cache directory. With record every call is
+    written to that file, to be replayed with loadgen.py"""
+    if build_workers:
+        set_build_workers(build_workers, build_timeout)
+    cls = Raw2Jpeg
+    if record:
+        from loadgen import RecordingRaw2Jpeg as cls
+    fs = cls(root, extents=extents, prefetch=prefetch,
+             prefetch_queue=prefetch_queue, attr_cache=attr_cache,
+             cache_size=cache_size, variants=variants)
+    if record:
+        fs.start_recording(record)
+    fs.tracer.dump_on_signal(join(previewcache.get_thumbdir(), "trace.txt"))
+    FUSE(fs, mountpoint, raw_fi=True, foreground=True, ro=True,
+         allow_other=True, nothreads=single_thread, entry_timeout=timeout,
+         attr_timeout=timeout)
+    if record:
+        fs.stop_recording()
 
 if __name__ == '__main__':
-    main(sys.argv[2], sys.argv[1])
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Mount a tree of raw files showing their jpeg previews")
+    parser.add_argument("root", help="Directory with the raw files")
+    parser.add_argument("mountpoint", nargs='?',
+                        help="Where to mount the filesystem")
+    parser.add_argument("-w", "--prewarm", action='store_true',
+                        help="Build the previews of every file under root "
+                        "and exit instead of mounting")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Processes used by --prewarm. All the cores "
+                        "by default")
+    parser.add_argument("-e", "--extents", action='store_true',
+                        help="Serve previews from inside the raw files "
+                        "instead of copying them to the cache")
+    parser.add_argument("-p", "--prefetch", type=int, default=0,
+                        metavar="N",
+                        help="Build the previews of listed directories in "
+                        "the background with N threads")
+    parser.add_argument("--prefetch-queue", type=int, default=500,
+                        metavar="N",
+                        help="Maximum number of files waiting to be "
+                        "prefetched")
+    parser.add_argument("-c", "--attr-cache", type=int, default=0,
+                        metavar="N",
+                        help="Keep up to N attributes and directory "
+                        "listings in memory")
+    parser.add_argument("-s", "--cache-size", type=int, default=0,
+                        metavar="MB",
+                        help="Remove the least recently used previews when "
+                        "the cache grows over this size")
+    parser.add_argument("-m", "--mmap", action='store_true',
+                        help="Parse the raw headers through a memory map "
+                        "of the file instead of reading them")
+    parser.add_argument("-t", "--timeout", type=float, default=10.0,
+                        metavar="SECONDS",
+                        help="How long the kernel caches names and "
+                        "attributes. Longer timeouts save calls but delay "
+                        "noticing changed raw files")
+    parser.add_argument("--single-thread", action='store_true',
+                        help="Handle one request at a time instead of "
+                        "using several libfuse threads")
+    parser.add_argument("-b", "--build-workers", type=int, default=0,
+                        metavar="N",
+                        help="Build the previews in N separate processes")
+    parser.add_argument("--build-timeout", type=float, default=30,
+                        metavar="SECONDS",
+                        help="Give up on files whose preview takes longer "
+                        "to build, when using --build-workers")
+    parser.add_argument("--variants", metavar="NAMES",
+                        help="List these previews too for each raw file, "
+                        "separated by commas: thumb, full or the pixels "
+                        "of their longest side. thumb,1920 lists "
+                        "IMG.dng.thumb.jpg and IMG.dng.1920.jpg")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Write every call to FILE, for loadgen.py "
+                        "to replay")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="Log debugging messages")
+    args = parser.parse_args()
+    previewcache.USE_MMAP = args.mmap
+    set_thumbdir(THUMBDIR)
+    level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=level)
+    DNG.logging.basicConfig(level=level)
+
+    variants = args.variants.split(",") if args.variants else []
+    for v in variants:
+        if v not in Raw2Jpeg.VARIANTS and not v.isdigit():
+            parser.error("Unknown variant %s" % v)
+
+    if args.prewarm:
+        sizes = [None, 0]
+        for v in variants:
+            size = Raw2Jpeg.VARIANTS[v] if v in Raw2Jpeg.VARIANTS else int(v)
+            if size not in sizes:
+                sizes.append(size)
+        prewarm(args.root, jobs=args.jobs, sizes=sizes)
+        sys.exit()
+    elif not args.mountpoint:
+        parser.error("A mountpoint is needed unless --prewarm is used")
+
+    main(args.mountpoint, args.root, extents=args.extents,
+         prefetch=args.prefetch, prefetch_queue=args.prefetch_queue,
+         attr_cache=args.attr_cache, cache_size=args.cache_size * 2**20,
+         timeout=args.timeout, single_thread=args.single_thread,
+         build_workers=args.build_workers, build_timeout=args.build_timeout,
+         record=args.record, variants=variants)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from os.path import dirname, join
+from struct import unpack_from, calcsize
+import os
+import threading
+
+import syscalls
+from DNG import logging
+
+
+def _encode(path):
+    """Paths are kept as bytes, like the names inotify reports, whether
+    they come as str or unicode"""
+    return path.encode('utf-8') if isinstance(path, unicode) else path
+
+
+class Inotify(object):
+    """Calls invalidate(path) for every change under the watched
+    directories, invalidate(path, True) when a directory is moved or
+    deleted, or invalidate(None) if events were lost"""
+
+    MASK = (syscalls.IN_MODIFY | syscalls.IN_ATTRIB |
+            syscalls.IN_CLOSE_WRITE | syscalls.IN_MOVED_FROM |
+            syscalls.IN_MOVED_TO | syscalls.IN_CREATE | syscalls.IN_DELETE |
+            syscalls.IN_DELETE_SELF | syscalls.IN_MOVE_SELF |
+            syscalls.IN_ONLYDIR)
+    # Events that change the listing of the directory
+    LISTING = (syscalls.IN_MOVED_FROM | syscalls.IN_MOVED_TO |
+               syscalls.IN_CREATE | syscalls.IN_DELETE)
+    # Events after which nothing under the watched directory is valid
+    TREE = syscalls.IN_MOVE_SELF | syscalls.IN_DELETE_SELF
+    EVENT = 'iIII'  # wd, mask, cookie, len, followed by the name
+
+    def __init__(self, invalidate):
+        self.invalidate = invalidate
+        self.fd = syscalls.inotify_init()
+        self.lock = threading.Lock()
+        self.wds = {}   # wd -> path
+        self.paths = {}  # path -> wd
+
+    def start(self):
+        t = threading.Thread(target=self._reader, name="inotify")
+        t.daemon = True
+        t.start()
+
+    def watch(self, path):
+        """Returns False if the directory could not be watched"""
+        path = _encode(path)
+        with self.lock:
+            if path in self.paths:
+                return True
+            try:
+                wd = syscalls.inotify_add_watch(self.fd, path, self.MASK)
+            except OSError as e:
+                logging.debug("Unable to watch %s: %s", path, e)
+                return False
+            self.wds[wd] = path
+            self.paths[path] = wd
+            return True
+
+    def forget(self, path):
+        """Stops watching path and the directories under it. A watch follows
+        its directory when it is moved, so its path would be wrong"""
+        prefix = path + '/'
+        with self.lock:
+            for p in [p for p in self.paths
+                      if p == path or p.startswith(prefix)]:
+                wd = self.paths.pop(p)
+                del self.wds[wd]
+                try:
+                    syscalls.inotify_rm_watch(self.fd, wd)
+                except OSError:
+                    pass  # Already removed with its directory
+
+    def _reader(self):
+        size = calcsize(self.EVENT)
+        while True:
+            buf = os.read(self.fd, 64 * 1024)
+            o = 0
+            while o < len(buf):
+                (wd, mask, cookie, length) = unpack_from(self.EVENT, buf, o)
+                name = buf[o+size:o+size+length].rstrip('\0')
+                o += size + length
+                try:
+                    self._event(wd, mask, name)
+                except Exception:
+                    # The thread must not die, or nothing is invalidated
+                    logging.warning("Error handling an inotify event")
+                    self.invalidate(None)
+
+    def _event(self, wd, mask, name):
+        if mask & syscalls.IN_Q_OVERFLOW:
+            self.invalidate(None)
+            return
+        with self.lock:
+            path = self.wds.get(wd)
+            if mask & syscalls.IN_IGNORED and path:
+                del self.wds[wd]
+                del self.paths[path]
+        if not path:
+            return
+        if mask & self.TREE:
+            self.forget(path)
+            self.invalidate(path, True)
+            return
+        if name:
+            if mask & syscalls.IN_MOVED_FROM and mask & syscalls.IN_ISDIR:
+                # Only the parent hears of the move of a directory
+                self.forget(join(path, name))
+                self.invalidate(join(path, name), True)
+            else:
+                self.invalidate(join(path, name))
+        if not name or mask & self.LISTING:
+            self.invalidate(path)
+
+
+class AttrCache(object):
+    """Bounded LRU cache of getattr results and directory listings.
+
+    Each entry depends on a source path in the original tree. It is dropped
+    when inotify reports a change to the source, or, when the source could
+    not be watched, when the mtime of the source changes."""
+
+    def __init__(self, size=10000, watch=True):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (source, mtime, watched, value)
+        self.by_source = {}  # source -> set of keys
+        self.inotify = None
+        if watch:
+            try:
+                self.inotify = Inotify(self.invalidate)
+            except (OSError, AttributeError):
+                logging.warning("inotify not available, checking mtimes")
+
+    def start(self):
+        if self.inotify:
+            self.inotify.start()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = entry  # Most recently used goes last
+        (source, mtime, watched, value) = entry
+        if not watched:
+            try:
+                if os.stat(source).st_mtime != mtime:
+                    self.invalidate(source)
+                    return None
+            except OSError:
+                self.invalidate(source)
+                return None
+        return value
+
+    def set(self, key, source, mtime, value, isdir=False):
+        source = _encode(source)
+        # Changes to a file are reported to the watch on its directory
+        watched = self.inotify is not None \
+            and self.inotify.watch(source if isdir else dirname(source))
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = (source, mtime, watched, value)
+            self.by_source.setdefault(source, set()).add(key)
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        try:
+            (source, mtime, watched, value) = self.entries.pop(key)
+        except KeyError:
+            return
+        keys = self.by_source[source]
+        keys.discard(key)
+        if not keys:
+            del self.by_source[source]
+
+    def drop(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def invalidate(self, source, tree=False):
+        """Forgets everything that depends on source, and with tree on the
+        paths under it too, or everything at all if source is None"""
+        with self.lock:
+            if source is None:
+                self.entries.clear()
+                self.by_source.clear()
+                return
+            source = _encode(source)
+            sources = [source]
+            if tree:
+                prefix = source + '/'
+                sources += [s for s in self.by_source if s.startswith(prefix)]
+            for s in sources:
+                for key in list(self.by_source.get(s, ())):
+                    self._drop(key)
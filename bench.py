@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the parser and the preview cache over a synthetic corpus.
+
+Each benchmark runs cold, with nothing parsed or cached beforehand, and
+warm, with the work it depends on already done. It reports calls per
+second and memory per call: the peak of bytes allocated when tracemalloc
+is available, else the objects left alive by each call."""
+from os.path import join
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import DNG
+import previewcache
+from stats import stats
+import synthdng
+
+
+def measure(op, prepare=None, seconds=1.0, min_calls=5, memory_calls=20):
+    """Calls op(n) for n = 0, 1... during about seconds, running prepare(n)
+    untimed before each call"""
+    elapsed = 0.0
+    n = 0
+    deadline = time.time() + seconds
+    while n < min_calls or time.time() < deadline:
+        prepare and prepare(n)
+        start = time.time()
+        op(n)
+        elapsed += time.time() - start
+        n += 1
+    res = {'calls': n, 'ops_per_sec': n / elapsed if elapsed else None}
+
+    # Memory, out of the timed runs as it slows them down
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    peak = 0
+    live = 0
+    for m in range(n, n + memory_calls):
+        prepare and prepare(m)
+        if tracemalloc:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        else:
+            gc.collect()
+            before = len(gc.get_objects())
+        op(m)
+        if tracemalloc:
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        else:
+            gc.collect()
+            live += len(gc.get_objects()) - before
+    if tracemalloc:
+        tracemalloc.stop()
+        res['peak_bytes_per_call'] = peak
+    else:
+        res['objects_per_call'] = live / float(memory_calls)
+    return res
+
+
+class Bench(object):
+    """The benchmarks, as methods named bench_<name> that return a dict of
+    measurements by cache state"""
+
+    def __init__(self, directory, files=40, seconds=1.0, **corpus):
+        self.directory = directory
+        self.seconds = seconds
+        paths = synthdng.corpus(join(directory, "raw"), files, **corpus)
+        self.dngs = [p for p in paths if p.endswith(".dng")]
+        self.rw2s = [p for p in paths if p.endswith(".rw2")]
+        self.paths = paths
+        self.cache = join(directory, "cache")
+
+    def reset_cache(self):
+        shutil.rmtree(self.cache, True)
+        previewcache.set_thumbdir(self.cache)
+
+    def measure(self, op, prepare=None):
+        return measure(op, prepare, self.seconds)
+
+    def pick(self, paths):
+        return lambda n: paths[n % len(paths)]
+
+    def bench_get_images(self):
+        path = self.pick(self.dngs)
+        opened = [DNG.DNG(p) for p in self.dngs]
+
+        def cold(n):
+            with DNG.DNG(path(n)) as dng:
+                dng.get_images()
+        res = {'cold': self.measure(cold),
+               'warm': self.measure(
+                   lambda n: opened[n % len(opened)].get_images())}
+        for dng in opened:
+            dng.close()
+        return res
+
+    def bench_parse_tags(self):
+        """Parsing every image of a file and reading each of their tags.
+        The parsed images of the last call are kept, so the memory is what
+        holding a parsed file costs"""
+        path = self.pick(self.dngs)
+        kept = []
+
+        def op(n):
+            with DNG.DNG(path(n)) as dng:
+                images = dng.get_images()
+                for image in images:
+                    for tag in image.tag_list:
+                        try:
+                            getattr(image, DNG.Tag.name_of(tag))
+                        except (AttributeError, NotImplementedError):
+                            pass
+            kept.append(images)
+        return {'cold': self.measure(op, prepare=lambda n: kept.pop()
+                                     if kept else None)}
+
+    def bench_read_jpeg_preview(self):
+        path = self.pick(self.dngs)
+        opened = [DNG.Preview(p) for p in self.dngs]
+
+        def cold(n):
+            with DNG.Preview(path(n)) as img:
+                img.read_jpeg_preview(-1)
+        res = {'cold': self.measure(cold),
+               'warm': self.measure(
+                   lambda n: opened[n % len(opened)].read_jpeg_preview(-1))}
+        for img in opened:
+            img.img.close()
+        return res
+
+    def bench_jpg_sniff(self):
+        """JPG() finding the exif tiff inside the PreviewImage of RW2s"""
+        offsets = []
+        for p in self.rw2s:
+            with DNG.Preview(p) as img:
+                img.img  # Parses the RW2 to learn the offset
+                offsets.append((p, img.preview_image))
+        pick = self.pick(offsets)
+
+        def op(n):
+            (p, offset) = pick(n)
+            DNG.JPG(p, offset=offset).close()
+        return {'cold': self.measure(op)}
+
+    def bench_get_preview(self):
+        path = self.pick(self.paths)
+
+        def miss(n):
+            if n % len(self.paths) == 0:
+                self.reset_cache()
+        res = {'cold': self.measure(lambda n: previewcache.get_preview(
+                   path(n)), prepare=miss)}
+        for p in self.paths:
+            previewcache.get_preview(p)
+        res['warm'] = self.measure(lambda n: previewcache.get_preview(
+            path(n)))
+        return res
+
+    def bench_get_layout(self):
+        path = self.pick(self.paths)
+
+        def miss(n):
+            previewcache.layouts._set(path(n), None)
+        res = {'cold': self.measure(
+                   lambda n: previewcache.get_layout(path(n)), prepare=miss)}
+        res['warm'] = self.measure(lambda n: previewcache.get_layout(path(n)))
+        return res
+
+    def bench_blacklist_match(self):
+        path = self.pick(self.paths)
+        mtimes = dict((p, os.path.getmtime(p)) for p in self.paths)
+        blacklist = previewcache.blacklist
+        res = {'cold': self.measure(
+                   lambda n: blacklist.match(path(n), mtimes[path(n)]))}
+        for p in self.paths:
+            blacklist.add(p)
+        res['warm'] = self.measure(
+            lambda n: blacklist.match(path(n), mtimes[path(n)]))
+        return res
+
+    def bench_stats(self):
+        """Counting and rendering the statistics, and reading them through
+        the virtual file of a Raw2Jpeg that is not mounted"""
+        for p in self.paths:
+            previewcache.get_preview(p)  # Fills the counters
+        res = {'add': self.measure(lambda n: stats.add('bench_calls')),
+               'json': self.measure(lambda n: stats.json()),
+               'prom': self.measure(lambda n: stats.prometheus())}
+        try:
+            from Raw2Jpeg import Raw2Jpeg
+        except EnvironmentError:
+            return res  # libfuse is not installed
+        fs = Raw2Jpeg(join(self.directory, "raw"))
+        path = Raw2Jpeg.STATS_DIR + "/stats.json"
+
+        def read(n):
+            size = fs('getattr', path, None)['st_size']
+            fh = fs('open', path, os.O_RDONLY)
+            fs('read', path, size, 0, fh)
+            fs('release', path, fh)
+        res['file'] = self.measure(read)
+        return res
+
+    def run(self, names=None):
+        results = {}
+        for attr in sorted(dir(self)):
+            name = attr[len('bench_'):]
+            if not attr.startswith('bench_') or names and name not in names:
+                continue
+            self.reset_cache()
+            results[name] = getattr(self, attr)()
+            for state, r in sorted(results[name].iteritems()):
+                if 'peak_bytes_per_call' in r:
+                    memory = "%10d bytes/call" % r['peak_bytes_per_call']
+                else:
+                    memory = "%10.1f objects/call" % r['objects_per_call']
+                print "%-20s %-4s %10.1f ops/s %s" % (name, state,
+                                                      r['ops_per_sec'],
+                                                      memory)
+        return results
+
+
+def compare(old, new):
+    """Prints the ratio of the ops/s of new to those of old"""
+    for name, states in sorted(new['results'].iteritems()):
+        for state, r in sorted(states.iteritems()):
+            try:
+                before = old['results'][name][state]['ops_per_sec']
+            except KeyError:
+                continue
+            print "%-20s %-4s %6.2fx" % (name, state,
+                                         r['ops_per_sec'] / before)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parser and the preview cache")
+    parser.add_argument("benchmarks", nargs='*',
+                        help="Which ones to run, all by default")
+    parser.add_argument("-n", "--files", type=int, default=40,
+                        help="Files in the synthetic corpus")
+    parser.add_argument("-t", "--seconds", type=float, default=1.0,
+                        help="Time spent in each measurement")
+    parser.add_argument("--ifds", type=int, default=1)
+    parser.add_argument("--depth", type=int, default=1)
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("-o", "--output", help="Save the results as json")
+    parser.add_argument("-c", "--compare", metavar="JSON",
+                        help="Compare with the results saved in this file")
+    args = parser.parse_args()
+
+    DNG.logging.basicConfig(level=DNG.logging.CRITICAL)
+    directory = tempfile.mkdtemp(prefix="raw2jpeg-bench")
+    try:
+        bench = Bench(directory, args.files, args.seconds, ifds=args.ifds,
+                      depth=args.depth, tags=args.tags)
+        results = bench.run(args.benchmarks)
+    finally:
+        previewcache.close()
+        shutil.rmtree(directory, True)
+
+    report = {'time': time.time(), 'python': sys.version.split()[0],
+              'machine': platform.machine(),
+              'corpus': {'files': args.files, 'ifds': args.ifds,
+                         'depth': args.depth, 'tags': args.tags},
+              'results': results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -70,6 +70,12 @@ if not _libfuse_path:
 else:
     _libfuse = CDLL(_libfuse_path)
 
+# libfuse frees the buffers returned by read_buf, so they come from malloc
+_libc = CDLL(find_library('c'))
+_libc.malloc.argtypes = [c_size_t]
+_libc.malloc.restype = c_voidp
+_libc.free.argtypes = [c_voidp]
+
 if _system == 'Darwin' and hasattr(_libfuse, 'macfuse_version'):
     _system = 'Darwin-MacFuse'
 
@@ -238,6 +244,24 @@ class fuse_file_info(Structure):
         ('fh', c_uint64),
         ('lock_owner', c_uint64)]
 
+FUSE_BUF_IS_FD = 1 << 1
+FUSE_BUF_FD_SEEK = 1 << 2
+
+class fuse_buf(Structure):
+    _fields_ = [
+        ('size', c_size_t),
+        ('flags', c_int),
+        ('mem', c_voidp),
+        ('fd', c_int),
+        ('pos', c_off_t)]
+
+class fuse_bufvec(Structure):
+    _fields_ = [
+        ('count', c_size_t),
+        ('idx', c_size_t),
+        ('off', c_size_t),
+        ('buf', fuse_buf * 1)]
+
 class fuse_context(Structure):
     _fields_ = [
         ('fuse', c_voidp),
@@ -311,6 +335,22 @@ class fuse_operations(Structure):
 
         ('utimens', CFUNCTYPE(c_int, c_char_p, POINTER(c_utimbuf))),
         ('bmap', CFUNCTYPE(c_int, c_char_p, c_size_t, POINTER(c_ulonglong))),
+
+        ('flag_nullpath_ok', c_uint, 1),
+        ('flag_nopath', c_uint, 1),
+        ('flag_utime_omit_ok', c_uint, 1),
+        ('flag_reserved', c_uint, 29),
+
+        ('ioctl', c_voidp),
+        ('poll', c_voidp),
+        ('write_buf', c_voidp),
+
+        ('read_buf', CFUNCTYPE(c_int, c_char_p,
+                               POINTER(POINTER(fuse_bufvec)), c_size_t,
+                               c_off_t, POINTER(fuse_file_info))),
+
+        ('flock', c_voidp),
+        ('fallocate', c_voidp),
     ]
 
 
@@ -382,7 +422,10 @@ class FUSE(object):
         argv = (c_char_p * len(args))(*args)
 
         fuse_ops = fuse_operations()
-        for name, prototype in fuse_operations._fields_:
+        for field in fuse_operations._fields_:
+            (name, prototype) = field[:2]
+            if len(field) == 3:
+                continue    # Flags, not operations
             if prototype != c_voidp and getattr(operations, name, None):
                 op = partial(self._wrapper, getattr(self, name))
                 setattr(fuse_ops, name, prototype(op))
@@ -505,10 +548,45 @@ class FUSE(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
         memmove(buf, ret, retsize)
         return retsize
 
+    def read_buf(self, path, bufpp, size, offset, fip):
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        ret = self.operations('read_buf', path.decode(self.encoding), size,
+                                          offset, fh)
+
+        bufv = cast(_libc.malloc(sizeof(fuse_bufvec)), POINTER(fuse_bufvec))
+        if not bufv:
+            return -ENOMEM
+        memset(bufv, 0, sizeof(fuse_bufvec))
+        bufv.contents.count = 1
+        buf = bufv.contents.buf[0]
+
+        if isinstance(ret, tuple):
+            # The data is read by libfuse, which may splice it
+            (buf.fd, buf.pos, buf.size) = ret
+            buf.flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK
+        else:
+            retsize = len(ret)
+            assert retsize <= size, \
+                'actual amount read %d greater than expected %d' % (retsize,
+                                                                    size)
+            buf.size = retsize
+            if retsize:
+                buf.mem = _libc.malloc(retsize)
+                if not buf.mem:
+                    _libc.free(bufv)
+                    return -ENOMEM
+                memmove(buf.mem, ret, retsize)
+
+        bufpp[0] = bufv
+        return 0
+
     def write(self, path, buf, size, offset, fip):
         data = string_at(buf, size)
 
@@ -817,6 +895,12 @@ class Operations(object):
 
         raise FuseOSError(EIO)
 
+    # Used instead of read when defined as read_buf(path, size, offset, fh).
+    # Returns either a string, or a tuple (fd, offset, size) for libfuse to
+    # read the data from the file descriptor itself, which avoids copying it
+    # through python and allows splicing.
+    read_buf = None
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
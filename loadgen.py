@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Replays traces of filesystem calls on Raw2Jpeg from several threads
+without mounting it, and reports the latency of each operation.
+
+Traces are files with one json call per line, either scripted from a
+tree of raw files or recorded from a live mount with RecordingMixIn
+(Raw2Jpeg.py --record).
+They go through Raw2Jpeg.__call__ like the calls of libfuse do, so the
+tracer and the stats see them too."""
+from __future__ import with_statement
+
+from ctypes import CDLL, POINTER, c_byte, cast, pointer
+from ctypes.util import find_library
+from functools import partial
+from os.path import join
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from fuse import FUSE, Operations, c_stat, fuse_file_info, \
+    fuse_operations
+import previewcache
+from Raw2Jpeg import Raw2Jpeg
+from syscalls import pread
+
+# Operations whose last argument is a file handle
+FH_OPS = ('getattr', 'read', 'read_buf', 'flush', 'release', 'fsync')
+# Operations of the mount itself, made once by libfuse
+MOUNT_OPS = ('init', 'destroy')
+
+
+class RecordingMixIn(object):
+    """Writes the calls made to the operations to a trace as they happen,
+    so a long recording takes no memory. Goes before the Operations class
+    in the bases, like fuse.LoggingMixIn. Nothing is recorded until
+    start_recording is called"""
+
+    recording = None  # The trace file
+
+    def start_recording(self, path):
+        self.recording_lock = threading.Lock()
+        self.recording = open(path, "w")
+
+    def stop_recording(self):
+        with self.recording_lock:
+            self.recording.close()
+            self.recording = None
+
+    def __call__(self, op, *args):
+        if self.recording is None:
+            return super(RecordingMixIn, self).__call__(op, *args)
+        start = time.time()
+        record = {'op': op, 'args': self._plain(op, args), 'start': start}
+        try:
+            ret = super(RecordingMixIn, self).__call__(op, *args)
+            if op == 'open':
+                # With raw_fi the handle is left in the fuse_file_info
+                record['fh'] = getattr(args[1], 'fh', ret)
+            return ret
+        finally:
+            record['elapsed'] = time.time() - start
+            line = json.dumps(record, default=repr) + "\n"
+            with self.recording_lock:
+                if self.recording:
+                    self.recording.write(line)
+
+    @staticmethod
+    def _plain(op, args):
+        """The arguments, with each fuse_file_info replaced by its flags
+        for open and by its handle otherwise"""
+        res = []
+        for a in args:
+            if isinstance(a, fuse_file_info):
+                a = a.flags if op == 'open' else a.fh
+            res.append(a)
+        return res
+
+
+class RecordingRaw2Jpeg(RecordingMixIn, Raw2Jpeg):
+    pass
+
+
+def script(root, chunk=128 * 1024, masked_only=True):
+    """A trace of a client browsing root: it lists each directory, stats
+    every entry and reads each masked file from start to end in chunks"""
+    fs = Raw2Jpeg(root)
+    trace = []
+    fh = 0
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        path = os.path.relpath(dirpath, root)
+        path = "/" if path == "." else "/" + path
+        dirnames.sort()
+        names = sorted(fs._masked(name) for name in dirnames + filenames)
+        trace.append({'op': 'readdir', 'args': [path, 0]})
+        for name in names:
+            trace.append({'op': 'getattr', 'args': [join(path, name), None]})
+        for name in names:
+            if masked_only and not fs._ismasked(name):
+                continue
+            fh += 1
+            name = join(path, name)
+            trace.append({'op': 'open', 'args': [name, os.O_RDONLY],
+                          'fh': fh})
+            trace.append({'op': 'read', 'args': [name, chunk, 0, fh],
+                          'to_eof': True})
+            trace.append({'op': 'release', 'args': [name, fh]})
+    return trace
+
+
+def save_trace(trace, path):
+    with open(path, "w") as f:
+        for record in trace:
+            f.write(json.dumps(record) + "\n")
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(durations, q):
+    """durations must be sorted"""
+    if not durations:
+        return None
+    return durations[max(0, int(math.ceil(q * len(durations))) - 1)]
+
+
+class Replay(object):
+    """Replays a trace on fs from clients threads at the same time, each of
+    them loops times over the whole trace"""
+
+    def __init__(self, fs, trace):
+        self.fs = fs
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.durations = {}  # op -> seconds of each call
+        self.errors = {}  # op -> number of failed calls
+        self.skipped = 0  # Calls on handles that failed to open
+
+    def call(self, op, args):
+        """Makes the call as libfuse would, going through the whole
+        listing and reading what read_buf points to"""
+        ret = self.fs(op, *args)
+        if op == 'readdir':
+            ret = list(ret)
+        elif op == 'read_buf' and isinstance(ret, tuple):
+            (fd, offset, size) = ret
+            ret = pread(fd, size, offset)
+        return ret
+
+    def timed(self, op, args, durations, errors):
+        start = time.time()
+        try:
+            return self.call(op, args)
+        except Exception:
+            # FUSE._wrapper turns every exception into an error code
+            errors[op] = errors.get(op, 0) + 1
+        finally:
+            durations.setdefault(op, []).append(time.time() - start)
+
+    def client(self, loops):
+        durations = {}
+        errors = {}
+        skipped = 0
+        for n in range(loops):
+            fhs = {}  # fh in the trace -> fh of this replay
+            for event in self.trace:
+                op = event['op']
+                if op in MOUNT_OPS:
+                    continue
+                args = list(event['args'])
+                if op in FH_OPS and args[-1] is not None:
+                    if args[-1] not in fhs:
+                        skipped += 1
+                        continue
+                    args[-1] = fhs[args[-1]]
+                if op == 'release':
+                    del fhs[event['args'][-1]]
+                if not event.get('to_eof'):
+                    ret = self.timed(op, args, durations, errors)
+                    if op == 'open' and 'fh' in event and ret is not None:
+                        fhs[event['fh']] = ret
+                    continue
+                # A sequential read of the whole file
+                (path, size, offset, fh) = args
+                while True:
+                    data = self.timed(op, [path, size, offset, fh],
+                                      durations, errors)
+                    if not data or len(data) < size:
+                        break
+                    offset += len(data)
+        with self.lock:
+            for op, d in durations.iteritems():
+                self.durations.setdefault(op, []).extend(d)
+            for op, e in errors.iteritems():
+                self.errors[op] = self.errors.get(op, 0) + e
+            self.skipped += skipped
+
+    def run(self, clients=1, loops=1):
+        threads = [threading.Thread(target=self.client, args=(loops,))
+                   for n in range(clients)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        ops = {}
+        calls = 0
+        for op, d in self.durations.iteritems():
+            d = sorted(d)
+            calls += len(d)
+            ops[op] = {'calls': len(d), 'errors': self.errors.get(op, 0),
+                       'p50': percentile(d, 0.5), 'p95': percentile(d, 0.95),
+                       'p99': percentile(d, 0.99), 'max': d[-1]}
+        return {'elapsed': elapsed, 'calls': calls, 'skipped': self.skipped,
+                'calls_per_sec': calls / elapsed if elapsed else None,
+                'operations': ops}
+
+
+def trampoline(calls=100000):
+    """Seconds per call of getattr and read through each layer between
+    libfuse and the operations: the operation alone, the FUSE method that
+    translates the arguments, FUSE._wrapper, and the ctypes callback that
+    libfuse calls.
+
+    The callback is called from python here, so its time includes a ctypes
+    call out to C, which the cost of calling getpid from libc estimates"""
+
+    class Null(Operations):
+        attrs = {'st_mode': 0100444, 'st_nlink': 1, 'st_size': 4096}
+
+        def getattr(self, path, fh=None):
+            return self.attrs
+
+        def read(self, path, size, offset, fh):
+            return "x" * size
+
+    fuse = FUSE.__new__(FUSE)  # Not mounted
+    fuse.operations = Null()
+    fuse.raw_fi = False
+    fuse.encoding = 'utf-8'
+    prototypes = dict(f[:2] for f in fuse_operations._fields_)
+
+    st = c_stat()
+    buf = (c_byte * 4096)()
+    fi = fuse_file_info()
+    calls_of = {
+        'getattr': (('getattr', u'/a', None), ('/a', pointer(st))),
+        'read': (('read', u'/a', 4096, 0, 0),
+                 ('/a', cast(buf, POINTER(c_byte)), 4096, 0, pointer(fi))),
+    }
+
+    def timeit(f, args):
+        start = time.time()
+        for n in xrange(calls):
+            f(*args)
+        return (time.time() - start) / calls
+
+    res = {}
+    for op, (op_args, fuse_args) in sorted(calls_of.iteritems()):
+        method = getattr(fuse, op)
+        wrapped = partial(FUSE._wrapper, method)
+        res[op] = {'operation': timeit(fuse.operations, op_args),
+                   'fuse': timeit(method, fuse_args),
+                   'wrapper': timeit(wrapped, fuse_args),
+                   'callback': timeit(prototypes[op](wrapped), fuse_args)}
+    res['ctypes_call'] = timeit(CDLL(find_library('c')).getpid, ())
+    return res
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Replay filesystem calls on Raw2Jpeg without mounting it")
+    parser.add_argument("root", nargs='?', help="Directory with the raw files")
+    parser.add_argument("-f", "--trace",
+                        help="Replay this trace instead of a scripted one")
+    parser.add_argument("-c", "--clients", type=int, default=1,
+                        help="Threads replaying the trace at the same time")
+    parser.add_argument("-l", "--loops", type=int, default=1,
+                        help="Times each client replays the trace")
+    parser.add_argument("--chunk", type=int, default=128 * 1024,
+                        help="Size of the reads of the scripted trace")
+    parser.add_argument("-e", "--extents", action='store_true',
+                        help="Serve previews from inside the raw files")
+    parser.add_argument("--attr-cache", type=int, default=0, metavar="N")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="Preview cache to use. A new empty one by "
+                        "default")
+    parser.add_argument("--save-trace", metavar="FILE",
+                        help="Save the scripted trace")
+    parser.add_argument("--trampoline", type=int, metavar="CALLS",
+                        help="Measure the cost of the ctypes callbacks "
+                        "instead")
+    parser.add_argument("-o", "--output", help="Save the results as json")
+    args = parser.parse_args()
+
+    if args.trampoline:
+        res = trampoline(args.trampoline)
+        for op in ('getattr', 'read'):
+            print "%-8s %s" % (op, "  ".join(
+                "%s %.2fus" % (layer, res[op][layer] * 1e6)
+                for layer in ('operation', 'fuse', 'wrapper', 'callback')))
+        print "ctypes call out to C %.2fus" % (res['ctypes_call'] * 1e6)
+    else:
+        if not args.root:
+            parser.error("The root directory is needed unless --trampoline "
+                         "is used")
+        cache = args.cache or tempfile.mkdtemp(prefix="raw2jpeg-loadgen")
+        previewcache.set_thumbdir(cache)
+        if args.trace:
+            trace = load_trace(args.trace)
+        else:
+            trace = script(args.root, args.chunk)
+            if args.save_trace:
+                save_trace(trace, args.save_trace)
+        fs = Raw2Jpeg(args.root, extents=args.extents,
+                      attr_cache=args.attr_cache)
+        fs.init('/')
+        try:
+            res = Replay(fs, trace).run(args.clients, args.loops)
+        finally:
+            previewcache.close()
+            if not args.cache:
+                shutil.rmtree(cache, True)
+        print "%d calls in %.2fs, %.1f calls/s, %d skipped" % (
+            res['calls'], res['elapsed'], res['calls_per_sec'],
+            res['skipped'])
+        print "%-10s %8s %6s %10s %10s %10s %10s" % (
+            "op", "calls", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms")
+        for op, r in sorted(res['operations'].iteritems()):
+            print "%-10s %8d %6d %10.3f %10.3f %10.3f %10.3f" % (
+                op, r['calls'], r['errors'], r['p50'] * 1e3, r['p95'] * 1e3,
+                r['p99'] * 1e3, r['max'] * 1e3)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=1, sort_keys=True)
@@ -7,6 +7,7 @@ import sys
 import errno
 
 from fuse import FUSE, FuseOSError, Operations
+from syscalls import pread, pwrite
 
 
 class Passthrough(Operations):
@@ -105,12 +106,10 @@ class Passthrough(Operations):
         return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        return pread(fh, length, offset)
 
     def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        return pwrite(fh, buf, offset)
 
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import Queue
+
+from previewcache import PreviewError
+from DNG import logging
+
+
+class Prefetcher(object):
+    """Builds the previews of the last listed directory in the background,
+    so that they are ready by the time the client opens them.
+
+    Only the directory listed most recently is prefetched. Listing a
+    different one cancels the work still queued for the previous one."""
+
+    def __init__(self, build, workers=2, max_queue=500):
+        self.build = build  # Called with the path of each raw file
+        self.workers = workers
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.directory = None
+        self.generation = 0
+        self.queued = set()
+        self.threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            t = threading.Thread(target=self._worker,
+                                 name="prefetch %d" % n)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def prefetch(self, directory, paths):
+        with self.lock:
+            if directory != self.directory:
+                self._cancel()
+                self.directory = directory
+            generation = self.generation
+            paths = [p for p in paths if p not in self.queued]
+            self.queued.update(paths)
+
+            # put_nowait does not block, so the lock can be held. Then
+            # _cancel never misses items being queued
+            for n, path in enumerate(paths):
+                try:
+                    self.queue.put_nowait((generation, path))
+                except Queue.Full:
+                    logging.debug("Prefetch queue full, dropping the rest "
+                                  "of %s", directory)
+                    self.queued.difference_update(paths[n:])
+                    break
+
+    def cancel(self):
+        """Drops the work queued for the last listed directory"""
+        with self.lock:
+            self._cancel()
+            self.directory = None
+
+    def _cancel(self):
+        # Called with the lock held. The stale items are taken out of the
+        # queue so that they do not fill the room of the next directory
+        self.generation += 1
+        self.queued = set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.queue.task_done()
+
+    def _worker(self):
+        while True:
+            (generation, path) = self.queue.get()
+            try:
+                if generation != self.generation:
+                    continue  # The user left the directory
+                self.build(path)
+                logging.debug("Prefetched %s", path)
+            except PreviewError:
+                pass
+            except:
+                logging.warning("Error prefetching %s", path)
+            finally:
+                self.queue.task_done()
@@ -1,105 +1,532 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from os.path import join, getmtime, dirname, basename
+from os.path import join, dirname
 import os
 import zlib
 import errno
 import subprocess
 import json
 import tempfile
+import threading
+import atexit
+import time
+import multiprocessing
+import Queue
 
 from DNG import Preview, logging
+from syscalls import copy_range
+from stats import stats
 
 PREVIEWDIR = "/tmp/.previewcache"
 FNULL = open(os.devnull, 'w')  # Se usa para redirigir a /dev/null
+USE_MMAP = False  # Parse the raw headers through a memory map of the file
 
 
 class PreviewError(StandardError):
     pass
 
 
-class Orientations():
-    def __init__(self):
-        self.o = {}
-        filename = join(get_thumbdir(), "orientations.txt")
+class BuildPoolBusy(PreviewError):
+    """No build process was free in time. The file itself may be fine"""
+
+
+class JournalStore(object):
+    """A dictionary saved as a json snapshot plus an append only journal.
+
+    Changes are queued in memory and a background thread appends them to the
+    journal in batches, so callers never wait for the disk. When the journal
+    grows too long it is folded into a new snapshot. Each journal line is a
+    json [key, value] pair, with a null value for deletions. A line cut short
+    by a crash is ignored on replay.
+
+    Every change goes through _set, which holds the lock, so the store can
+    be used from the libfuse threads. Lookups read the dictionary without
+    locking, since a single get or set of a dict is atomic in CPython."""
+
+    FLUSH_INTERVAL = 5      # Seconds between journal writes
+    FLUSH_RECORDS = 200     # Pending records that trigger an early write
+    COMPACT_RECORDS = 20000  # Journal records that trigger a new snapshot
+
+    def __init__(self, filename):
+        self.filename = join(get_thumbdir(), filename)
+        self.journalname = self.filename + ".journal"
+        self.d = {}
+        self.pending = []
+        self.journal_records = 0
+        self.damaged = False  # The last write to the journal failed
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.io_lock = threading.Lock()
+
+        self._load()
         try:
-            self.o_file = open(filename, "r+")
-            self.o = json.loads(self.o_file.read())
+            self.journal = open(self.journalname, "a")
         except:
+            self.journal = None
+            logging.warning(
+                "Error trying to open journal %s for writing",
+                self.journalname)
+
+        self.writer = threading.Thread(target=self._writer,
+                                       name="journal " + filename)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                data = f.read()
+            if data:
+                self.d = json.loads(data)
+        except IOError:
+            pass
+        except ValueError:
+            logging.warning("Error loading snapshot %s", self.filename)
+
+        try:
+            with open(self.journalname) as f:
+                for line in f:
+                    if not line.strip():
+                        continue  # Left after a failed write
+                    try:
+                        (key, value) = json.loads(line)
+                    except ValueError:
+                        logging.warning("Ignoring damaged record in %s",
+                                        self.journalname)
+                        continue
+                    if value is None:
+                        self.d.pop(key, None)
+                    else:
+                        self.d[key] = value
+                    self.journal_records += 1
+        except IOError:
+            pass
+
+    def _set(self, key, value):
+        with self.lock:
+            if value is None:
+                self.d.pop(key, None)
+            else:
+                self.d[key] = value
+            self.pending.append((key, value))
+            if len(self.pending) >= self.FLUSH_RECORDS:
+                self.wakeup.notify()
+
+    def _writer(self):
+        failed = False
+        while True:
+            with self.lock:
+                if (failed or not self.pending) and not self.closed:
+                    self.wakeup.wait(self.FLUSH_INTERVAL)
+                closed = self.closed
             try:
-                self.o_file = open(filename, "w")
+                self.flush()
+                if self.journal_records > self.COMPACT_RECORDS:
+                    self.compact()
+                failed = False
+            except EnvironmentError as e:
+                # The disk may be full for a while. The records are kept
+                # and written on the next try
+                logging.warning("Error writing %s: %s", self.journalname, e)
+                failed = True
+            if closed:
+                return
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                (pending, self.pending) = (self.pending, [])
+            if not pending or not self.journal:
+                return
+            # A write that failed may have left a line cut short, which the
+            # new line keeps apart from the records retried
+            data = "".join(json.dumps(r) + "\n" for r in pending)
+            try:
+                self.journal.write("\n" + data if self.damaged else data)
+                self.journal.flush()
             except:
-                logging.warning(
-                    "Error trying to open orientation file %s for writing"
-                    % filename)
+                with self.lock:
+                    self.pending[:0] = pending
+                self.damaged = True
+                raise
+            self.damaged = False
+            self.journal_records += len(pending)
+
+    def compact(self):
+        with self.io_lock:
+            # The journal is up to date with self.d, so a crash after the
+            # rename only replays records already in the snapshot. Records
+            # set while it is written wait in pending for the next flush
+            with self.lock:
+                if self.pending or not self.journal:
+                    return  # Let the writer flush them first
+                d = dict(self.d)
+            snapshot = json.dumps(d)
+            tmp = self.filename + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.filename)
+            self.journal.seek(0)
+            self.journal.truncate()
+            self.journal_records = 0
+            logging.debug("Compacted %s", self.filename)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.writer.join()
+        if self.journal:
+            try:
+                self.journal.close()
+            except EnvironmentError as e:
+                logging.warning("Error closing %s: %s", self.journalname, e)
+            self.journal = None
 
-    def _save(self):
-        self.o_file.seek(0)
-        self.o_file.truncate()
-        self.o_file.write(json.dumps(self.o))
-        self.o_file.flush()
+
+class Orientations(JournalStore):
+    def __init__(self):
+        super(Orientations, self).__init__("orientations.txt")
 
     def set(self, path, orientation):
-        logging.debug("Setting orientation %d for %s" % (orientation, path))
-        self.o[path] = orientation
-        self._save()
+        logging.debug("Setting orientation %d for %s", orientation, path)
+        self._set(path, orientation)
 
     def get(self, path):
         try:
-            return self.o[path]
+            return self.d[path]
         except:
-            logging.warning("Orientation not found for %s" % path)
+            logging.warning("Orientation not found for %s", path)
             return 1
 
+    def remove(self, path):
+        if path in self.d:
+            self._set(path, None)
 
-class Blacklist():
+
+class Layouts(JournalStore):
+    """What the headers of each original file say, as returned by
+    read_layout. Used to serve previews in extent mode, to know their size
+    and orientation, and to extract them, without parsing the file again"""
     def __init__(self):
-        self.bl = {}
-        filename = join(get_thumbdir(), "blacklist.txt")
-        try:
-            self.blfile = open(filename, "r+")
-            self.bl = json.loads(self.blfile.read())
-        except:
-            try:
-                self.blfile = open(filename, "w")
-            except:
-                logging.warning(
-                    "Error loading preview blacklist file %s" % filename)
+        super(Layouts, self).__init__("layouts.txt")
+
+    def set(self, path, layout):
+        logging.debug("Setting layout for %s", path)
+        self._set(path, layout)
 
-    def _save(self):
-        self.blfile.seek(0)
-        self.blfile.truncate()
-        self.blfile.write(json.dumps(self.bl))
-        self.blfile.flush()
+    def get(self, path, st):
+        """Returns the layout or None if unknown or stale"""
+        layout = self.d.get(path)
+        if layout and layout['size'] == st.st_size \
+                and layout['mtime'] == st.st_mtime:
+            return layout
+        return None
+
+
+class Blacklist(JournalStore):
+    def __init__(self):
+        super(Blacklist, self).__init__("blacklist.txt")
 
     def add(self, path):
-        logging.debug("Blacklisting %s" % path)
-        self.bl[path] = os.path.getmtime(path)
-        self._save()
+        logging.debug("Blacklisting %s", path)
+        self._set(path, os.path.getmtime(path))
 
     def match(self, path, origmtime=None):
         try:
             # It is a match if the date did not change
             origmtime = origmtime or os.path.getmtime(path)
-            return origmtime == self.bl[path]
+            return origmtime == self.d[path]
         except:
+            if path in self.d:
+                self._set(path, None)
+        return False
+
+
+class Built(JournalStore):
+    """The preview last built of each original file in each size, so the
+    one of a previous version of the file is removed when it is replaced.
+    Keyed by the path, so a file that is both renamed and changed leaves
+    its old preview to the reaper"""
+    def __init__(self):
+        super(Built, self).__init__("built.txt")
+
+    def replace(self, origpath, size, preview):
+        """Records preview, and returns the preview it replaces if any"""
+        key = "%s:%s" % (size, origpath)
+        previous = self.d.get(key)
+        if previous != preview:
+            self._set(key, preview)
+            return previous
+        return None
+
+
+class Reaper(object):
+    """Keeps the previews and thumbnails under a budget of bytes. get_preview
+    reports every preview it serves, and a background thread removes the
+    least recently used ones when the cache grows over the budget"""
+
+    INTERVAL = 60     # Seconds between checks
+    LOW_WATER = 0.9   # Fraction of the budget left after reaping
+    GRACE = 120       # Seconds a served preview is safe from eviction
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.files = {}  # preview -> [last access, size]
+        self.total = 0
+
+    def start(self):
+        t = threading.Thread(target=self._run, name="reaper")
+        t.daemon = True
+        t.start()
+
+    def touch(self, preview, size=None):
+        with self.lock:
+            entry = self.files.get(preview)
+            if entry and size is None:
+                entry[0] = time.time()
+                return
+        if size is None:
             try:
-                self.bl.pop(path)
-                self._save()
+                size = os.path.getsize(preview)
+            except OSError:
+                return
+        with self.lock:
+            entry = self.files.setdefault(preview, [0, 0])
+            self.total += size - entry[1]
+            entry[:] = [time.time(), size]
+
+    def forget(self, preview):
+        with self.lock:
+            entry = self.files.pop(preview, None)
+            if entry:
+                self.total -= entry[1]
+
+    def scan(self):
+        """Learns the previews that were already in the cache, with their
+        access time as the last use"""
+        try:
+            p_types = [p for p in os.listdir(PREVIEWDIR)
+                       if p.startswith(('previews', 'thumbnails'))]
+        except OSError:
+            p_types = []
+        for p_type in p_types:
+            for dirpath, dirnames, filenames in os.walk(join(PREVIEWDIR,
+                                                             p_type)):
+                for f in filenames:
+                    if f.endswith('.tmp'):
+                        continue  # Being built, or swept at start
+                    path = join(dirpath, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    with self.lock:
+                        if path not in self.files:
+                            self.files[path] = [st.st_atime, st.st_size]
+                            self.total += st.st_size
+
+    def reap(self):
+        with self.lock:
+            if self.total <= self.budget:
+                return
+            target = self.total - self.budget * self.LOW_WATER
+            recent = time.time() - self.GRACE
+            victims = sorted((atime, size, path) for path, (atime, size)
+                             in self.files.iteritems() if atime < recent)
+
+        freed = 0
+        for atime, size, path in victims:
+            if freed >= target:
+                break
+            with self.lock:
+                entry = self.files.get(path)
+                if not entry or entry[0] != atime:
+                    continue  # Used since we looked
+                del self.files[path]
+                self.total -= entry[1]
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            orientations.remove(path)
+            freed += size
+        logging.info("Evicted %d bytes from the preview cache", freed)
+
+    def _run(self):
+        self.scan()
+        while True:
+            try:
+                self.reap()
             except:
+                logging.warning("Error reaping the preview cache")
+            time.sleep(self.INTERVAL)
+
+
+def set_cache_size(budget):
+    """Limits the previews and thumbnails to budget bytes"""
+    global reaper
+    reaper = Reaper(budget)
+    reaper.start()
+
+
+def _build_worker(conn):
+    """Main loop of the build processes. Without a preview to build only
+    the layout is returned"""
+    while True:
+        try:
+            (origpath, st, preview, size, layout) = conn.recv()
+        except EOFError:
+            return  # The parent is gone
+        try:
+            # The headers are parsed here too, as they may be as slow or
+            # broken as the rest of the file
+            layout = layout or read_layout(origpath, st)
+            if preview is None:
+                conn.send((True, (None, None, layout)))
+                continue
+            conn.send((True, build_preview(origpath, preview, size, layout)
+                       + (layout,)))
+        except Exception as e:
+            conn.send((False, str(e) or e.__class__.__name__))
+
+
+class BuildPool(object):
+    """Builds previews in separate processes, so that a slow or broken raw
+    file holds neither a libfuse thread nor the GIL. A build that takes
+    longer than timeout seconds is abandoned and its process replaced, and
+    a caller waits as long at most for a process to be free"""
+
+    def __init__(self, workers, timeout):
+        self.timeout = timeout
+        self.idle = Queue.Queue()
+        for n in range(workers):
+            self.idle.put(self._spawn())
+
+    @staticmethod
+    def _spawn():
+        (conn, child_conn) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_build_worker,
+                                          args=(child_conn,))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return (process, conn)
+
+    def build(self, origpath, st, preview, size=None, layout=None):
+        """Returns (preview, orientation, layout). The headers are parsed
+        in the process if layout is None"""
+        return self._run((origpath, st, preview, size, layout), preview)
+
+    def probe(self, origpath, st):
+        """The layout of origpath, parsed in a process"""
+        return self._run((origpath, st, None, None, None), origpath)[2]
+
+    def _run(self, args, name):
+        preview = args[2]
+        try:
+            (process, conn) = self.idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise BuildPoolBusy("No process free for %s" % name)
+        try:
+            conn.send(args)
+            if conn.poll(self.timeout):
+                (ok, result) = conn.recv()
+            else:
+                (ok, result) = (False, None)
+        except (EOFError, IOError):
+            (ok, result) = (False, None)
+
+        if result is None:
+            # Timed out or died, maybe leaving a half written preview
+            logging.warning("Killing the build of %s", name)
+            process.terminate()
+            process.join()
+            conn.close()
+            try:
+                preview and os.unlink(temp_path(preview, process.pid))
+            except OSError:
                 pass
-        return False
+            (process, conn) = self._spawn()
+        self.idle.put((process, conn))
+
+        if not ok:
+            raise PreviewError(result or "Timed out on %s" % name)
+        return result
+
+
+def set_build_workers(workers, timeout):
+    """Builds the previews in workers processes, giving up on a file after
+    timeout seconds. Call it before mounting, so that the processes are not
+    forked from the libfuse threads"""
+    global build_pool
+    build_pool = BuildPool(workers, timeout)
+
+
+class InFlight(object):
+    """Runs at most one call per key at a time. Callers arriving while the
+    call for their key is running wait for it and share its result, or its
+    exception"""
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, f, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            first = call is None
+            if first:
+                call = self.calls[key] = self.Call()
+
+        if not first:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = f(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+in_flight = InFlight()
 
 
 def set_thumbdir(thumbdir):
-    global PREVIEWDIR, orientations, blacklist
+    global PREVIEWDIR, orientations, layouts, blacklist, built
+    for store in (orientations, layouts, blacklist, built):
+        store and store.close()
     PREVIEWDIR = thumbdir
     try:
         tempfile.TemporaryFile(dir=thumbdir)
     except:
         os.makedirs(thumbdir)
     orientations = Orientations()
+    layouts = Layouts()
     blacklist = Blacklist()
+    built = Built()
+    t = threading.Thread(target=sweep_temp_files, args=(thumbdir,),
+                         name="sweeper")
+    t.daemon = True
+    t.start()
 
 
 def get_thumbdir():
@@ -107,76 +534,316 @@ def get_thumbdir():
 
 
 def get_crc(path):
-    return "{0:x}".format(zlib.crc32(path.encode('utf-8')) & 0xffffffff)
+    return "{0:08x}".format(zlib.crc32(path.encode('utf-8')) & 0xffffffff)
+
+
+def preview_path(origpath, size=None, st=None):
+    """The preview is named after the identity of the original file, so it
+    is still found after the file or its folders are renamed, and a changed
+    file gets a new name. The crc of the name spreads the previews over
+    256*256 directories. Each size has directories of its own"""
+    st = st or os.stat(origpath)
+    if size is None:
+        p_type = 'previews'
+    elif size == 0:
+        p_type = 'thumbnails'
+    else:
+        p_type = 'previews-%d' % size
+    name = "%x-%x-%x-%x" % (st.st_dev, st.st_ino, st.st_size,
+                            int(st.st_mtime * 1000000))
+    crc = get_crc(name)
+    return join(PREVIEWDIR, p_type, crc[:2], crc[2:4], name + '.jpg')
+
 
+def is_built(preview):
+    """The name of the preview changes with the size and mtime of the
+    original, and it only appears once complete, so if it exists it is up
+    to date"""
+    return os.path.exists(preview)
 
-def get_preview(origpath, thumbnail=False, return_orientation=False):
-    # TODO when the rest is working go back to using crcs as the filename
-    p_type = 'thumbnails' if thumbnail else 'previews'
-    preview = join(
-        PREVIEWDIR, p_type, dirname(origpath)[1:], basename(origpath)+'.jpg')
+
+def add_preview(origpath, size, preview, orientation):
+    """Records a newly built preview, removing the one built for a previous
+    version of origpath. Without it the cache would keep every version of
+    the files that change, unless a size limit is set"""
+    orientations.set(preview, orientation)
+    reaper and reaper.touch(preview, os.path.getsize(preview))
+    previous = built.replace(origpath, size, preview)
+    if previous:
+        logging.debug("Removing %s, replaced by %s", previous, preview)
+        try:
+            os.unlink(previous)
+        except OSError:
+            pass
+        orientations.remove(previous)
+        reaper and reaper.forget(previous)
+
+
+def get_preview(origpath, size=None, return_orientation=False):
+    """Path of the cached preview of origpath, built if needed. size picks
+    the preview as in pick_preview"""
+    st = os.stat(origpath)
+    preview = preview_path(origpath, size, st)
 
     try:
-        origmtime = getmtime(origpath)
-        prevmtime = getmtime(preview)
-        if prevmtime >= origmtime:
+        if is_built(preview):
+            stats.add('preview_hits')
+            reaper and reaper.touch(preview)
             if not return_orientation:
                 return preview
             else:
-                return (preview, orientations.get(preview))
+                return (preview, get_orientation(origpath, preview, st))
     except:
         pass  # The preview is not yet built
 
-    if blacklist.match(origpath, origmtime=origmtime):
+    # Concurrent callers wait for the build started by the first one
+    orientation = in_flight.run(preview, _build, origpath, st, preview,
+                                size)
+
+    if not return_orientation:
+        return preview
+    else:
+        return (preview, orientation)
+
+
+def _build(origpath, st, preview, size):
+    if is_built(preview):
+        # Built while we waited
+        return get_orientation(origpath, preview, st)
+
+    if blacklist.match(origpath, origmtime=st.st_mtime):
+        stats.add('blacklist_hits')
         raise PreviewError
 
+    start = time.time()
+    stats.gauge('builds_in_flight', 1)
     try:
-        (preview, orientation) = build_preview(origpath, preview, thumbnail)
+        if build_pool:
+            # An unknown layout is parsed by the worker, under its timeout
+            layout = layouts.get(origpath, st)
+            (preview, orientation, new) = build_pool.build(
+                origpath, st, preview, size, layout)
+            if not layout:
+                stats.add('layout_parses')
+                layouts.set(origpath, new)
+        else:
+            layout = get_layout(origpath, st)
+            (preview, orientation) = build_preview(origpath, preview,
+                                                   size, layout)
+    except BuildPoolBusy:
+        stats.add('build_pool_busy')
+        raise
     except:
+        stats.add('build_failures')
         blacklist.add(origpath)
         raise PreviewError
+    finally:
+        stats.gauge('builds_in_flight', -1)
 
-    orientations.set(preview, orientation)
+    stats.add('preview_builds')
+    stats.time('build_seconds', time.time() - start)
+    add_preview(origpath, size, preview, orientation)
+    return orientation
+
+
+def get_orientation(origpath, preview, st):
+    """The orientation of a built preview. If the journal lost it, it is
+    taken from the layout of the original"""
+    if preview in orientations.d:
+        return orientations.get(preview)
+    try:
+        return get_layout(origpath, st)['orientation']
+    except PreviewError:
+        return orientations.get(preview)
 
-    if not return_orientation:
-        return preview
-    else:
-        return (preview, orientation)
 
+def read_layout(origpath, st):
+    """Parses the headers of origpath. The layout is stamped with the size
+    and mtime of the file it belongs to"""
+    with Preview(origpath) as img:
+        layout = img.layout()
+    layout['size'] = st.st_size
+    layout['mtime'] = st.st_mtime
+    return layout
 
-def build_preview(origpath, preview, thumbnail):
+
+def get_layout(origpath, st=None):
+    """The layout of origpath, parsing its headers only if it is unknown or
+    the file changed since it was stored"""
     try:
-        os.makedirs(dirname(preview))
+        st = st or os.stat(origpath)
+    except OSError:
+        raise PreviewError
+
+    layout = layouts.get(origpath, st)
+    if layout:
+        stats.add('layout_hits')
+        return layout
+
+    return in_flight.run('layout:' + origpath, _probe_layout, origpath, st)
+
+
+def _probe_layout(origpath, st):
+    layout = layouts.get(origpath, st)
+    if layout:
+        return layout
+
+    if blacklist.match(origpath, origmtime=st.st_mtime):
+        stats.add('blacklist_hits')
+        raise PreviewError
+
+    stats.add('layout_parses')
+    try:
+        if build_pool:
+            # Under the timeout of the pool, so that a broken file does not
+            # hold the getattr or the listing that asked for its size
+            layout = build_pool.probe(origpath, st)
+        else:
+            layout = read_layout(origpath, st)
+    except BuildPoolBusy:
+        stats.add('build_pool_busy')
+        raise
+    except:
+        blacklist.add(origpath)
+        raise PreviewError
+
+    layouts.set(origpath, layout)
+    return layout
+
+
+def pick_preview(layout, size=None):
+    """The [offset, length, width, height, compression] of the smallest
+    preview in layout whose longest side is at least size pixels. The
+    largest one if size is None or none is that large, the smallest if size
+    is 0"""
+    previews = layout['previews']
+    if size is not None:
+        for p in previews:
+            if max(p[2], p[3]) >= size:
+                return p
+    return previews[-1]
+
+
+def get_extent(origpath, size=None):
+    """Returns (offset, length, orientation) of the preview embedded in
+    origpath, parsing only the headers. Nothing is copied to the cache"""
+    layout = get_layout(origpath)
+    (offset, length) = pick_preview(layout, size)[:2]
+    return (offset, length, layout['orientation'])
+
+
+def get_preview_size(origpath, size=None):
+    """Size the preview has or will have once built. If it is not in the
+    cache only the headers of origpath are read"""
+    try:
+        return os.path.getsize(preview_path(origpath, size))
+    except OSError:
+        pass
+    return get_extent(origpath, size)[1]
+
+
+def temp_path(preview, pid=None):
+    """Where the process pid writes preview until it is complete"""
+    return "%s.%d.tmp" % (preview, pid or os.getpid())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exception:
+        return exception.errno != errno.ESRCH
+    return True
+
+
+def sweep_temp_files(thumbdir=None):
+    """Removes the temporary previews of the processes that died while
+    writing them. Those of live processes may still be renamed"""
+    thumbdir = thumbdir or PREVIEWDIR
+    try:
+        p_types = [p for p in os.listdir(thumbdir)
+                   if p.startswith(('previews', 'thumbnails'))]
+    except OSError:
+        return
+    for p_type in p_types:
+        for dirpath, dirnames, filenames in os.walk(join(thumbdir, p_type)):
+            for f in filenames:
+                if not f.endswith('.tmp'):
+                    continue
+                try:
+                    pid = int(f.split('.')[-2])
+                except ValueError:
+                    continue
+                if _alive(pid):
+                    continue
+                logging.debug("Removing %s, left by process %d", f, pid)
+                try:
+                    os.unlink(join(dirpath, f))
+                    stats.add('temp_files_swept')
+                except OSError:
+                    pass
+
+
+def build_preview(origpath, preview, size=None, layout=None):
+    """Extracts the preview. With the layout of origpath the headers are not
+    parsed again. The jpeg is copied by the kernel to a temporary file that
+    is renamed once complete, so the preview is never seen half written"""
+    tmp = temp_path(preview)
+    try:
+        out = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
     except OSError as exception:
-        if exception.errno != errno.EEXIST:
+        if exception.errno != errno.ENOENT:
             raise
+        # First preview in this shard
+        try:
+            os.makedirs(dirname(preview))
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        out = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
 
     try:
-        with open(preview, "w") as out, Preview(origpath) as img:
-            if thumbnail:
-                out.write(img.read_jpeg_preview(0))  # The smallest available
-            else:
-                out.write(img.read_jpeg_preview(-1))  # The largest available
+        with Preview(origpath, mapped=USE_MMAP, layout=layout) as img:
+            (offset, length) = pick_preview(img.layout(), size)[:2]
             orientation = img.Orientation
+        with open(origpath, "rb") as f:
+            if copy_range(f.fileno(), out, offset, length) != length:
+                raise IOError("%s is truncated" % origpath)
+        os.close(out)
+        out = None
+        os.rename(tmp, preview)
+
+        # XBMC no interpreta el exif del tif. Sacamos el JPEG embebido
+
+        # Commented out because for some reason it is failing
+        # in the rspbrry pi
+        # try:
+        #     subprocess.call(
+        #         ["exiv2", preview,
+        #          "-Mset Exif.Image.Orientation %s" % orientation],
+        #         stderr=FNULL)
+        # except:
+        #     logging.debug("Unable to set Orientation information")
+
+        logging.debug("Built %s preview", preview)
+        return (preview, orientation)
+    except:
+        if out is not None:
+            os.close(out)
+        os.unlink(tmp)
+        raise
 
-            # XBMC no interpreta el exif del tif. Sacamos el JPEG embebido
 
-            # Commented out because for some reason it is failing
-            # in the rspbrry pi
-            # try:
-            #     subprocess.call(
-            #         ["exiv2", preview,
-            #          "-Mset Exif.Image.Orientation %s" % orientation],
-            #         stderr=FNULL)
-            # except:
-            #     logging.debug("Unable to set Orientation information")
+def close():
+    """Writes out the pending journal records"""
+    for store in (orientations, layouts, blacklist, built):
+        store.close()
 
-            logging.debug("Built %s preview" % preview)
-            return (preview, orientation)
-    except:
-        os.unlink(preview)
-        raise
 
 orientations = None
+layouts = None
 blacklist = None
+built = None
+reaper = None
+build_pool = None
 set_thumbdir(PREVIEWDIR)
+atexit.register(close)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+from tracing import Histogram
+
+
+class Stats(object):
+    """Counters and latency histograms of the whole process, rendered as
+    json or in the Prometheus text format"""
+
+    PREFIX = "raw2jpeg_"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}  # name -> number
+        self.gauges = {}  # name -> number
+        self.histograms = {}  # name -> Histogram of seconds
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, n):
+        """Moves the gauge by n, which can be negative"""
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + n
+
+    def time(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self, operations=None):
+        """operations are the latency histograms of a Tracer"""
+        with self.lock:
+            res = {'uptime': time.time() - self.started,
+                   'counters': dict(self.counters),
+                   'gauges': dict(self.gauges),
+                   'histograms': dict((name, h.as_dict()) for name, h
+                                      in self.histograms.iteritems())}
+        res['operations'] = operations or {}
+        return res
+
+    def json(self, operations=None):
+        return json.dumps(self.snapshot(operations), indent=1,
+                          sort_keys=True) + "\n"
+
+    def prometheus(self, operations=None):
+        snapshot = self.snapshot(operations)
+        p = self.PREFIX
+        lines = ["# TYPE %suptime_seconds gauge" % p,
+                 "%suptime_seconds %f" % (p, snapshot['uptime'])]
+        for name, value in sorted(snapshot['counters'].iteritems()):
+            lines.append("# TYPE %s%s_total counter" % (p, name))
+            lines.append("%s%s_total %d" % (p, name, value))
+        for name, value in sorted(snapshot['gauges'].iteritems()):
+            lines.append("# TYPE %s%s gauge" % (p, name))
+            lines.append("%s%s %d" % (p, name, value))
+        for name, h in sorted(snapshot['histograms'].iteritems()):
+            lines.append("# TYPE %s%s histogram" % (p, name))
+            lines.extend(self._histogram(p + name, h, ""))
+        if snapshot['operations']:
+            lines.append("# TYPE %soperation_seconds histogram" % p)
+            for op, h in sorted(snapshot['operations'].iteritems()):
+                lines.extend(self._histogram(p + "operation_seconds", h,
+                                             'op="%s",' % op))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram(name, h, labels):
+        # Every bucket is written, so the series do not come and go
+        seen = 0
+        for n in range(Histogram.BUCKETS):
+            le = 2 ** n / 1000000.0
+            seen += h['buckets'].get(le, 0)
+            yield '%s_bucket{%sle="%g"} %d' % (name, labels, le, seen)
+        yield '%s_bucket{%sle="+Inf"} %d' % (name, labels, h['count'])
+        labels = "{%s}" % labels.rstrip(",") if labels else ""
+        yield '%s_sum%s %f' % (name, labels, h['total'])
+        yield '%s_count%s %d' % (name, labels, h['count'])
+
+
+stats = Stats()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Writes synthetic tiff based raw files to benchmark the parser and the
+cache with. The files are well formed DNG and RW2 containers with jpeg
+previews of the chosen sizes, but they carry no real image data."""
+from struct import pack
+import os
+import random
+
+from DNG import Tag
+
+DNGVersion = 50706
+NewSubFileType = Tag.SubFileType
+
+# Sizes of the previews of a camera that embeds a full size one
+SIZES = ((160, 120, 8 * 1024), (1024, 768, 150 * 1024),
+         (6000, 4000, 4 * 1024 * 1024))
+
+
+def jpeg(size, width, height):
+    """A jpeg stream of size bytes with the given dimensions in its frame
+    header, padded with comment segments"""
+    sof = pack('>BHHB', 8, height, width, 3) + \
+        ''.join(pack('>BBB', c, 0x11, 0) for c in (1, 2, 3))
+    head = '\xff\xd8' + '\xff\xc0' + pack('>H', len(sof) + 2) + sof
+    pad = size - len(head) - 2
+    body = []
+    while pad > 0:
+        n = min(pad, 0xffff + 2)
+        if 0 < pad - n < 4:
+            n -= 4  # Leave room for one more segment
+        body.append('\xff\xfe' + pack('>H', n - 2) + 'x' * (n - 4))
+        pad -= n
+    return head + ''.join(body) + '\xff\xd9'
+
+
+class Blob(object):
+    """Data stored after the IFDs, like the jpeg of a preview"""
+    def __init__(self, data):
+        self.data = data
+        self.offset = None
+
+
+class IFD(object):
+    """An IFD being written. Values are lists of numbers, strings for
+    ASCII and UNDEFINED, or Blob and IFD objects that become their offset"""
+
+    def __init__(self):
+        self.entries = {}  # tag -> (type, values)
+        self.children = []  # IFDs and blobs pointed to by the entries
+        self.next = None
+        self.offset = None
+
+    def add(self, tag, type, values):
+        if not isinstance(values, (list, tuple, str)):
+            values = [values]
+        self.entries[tag] = (type, values)
+        for v in values if not isinstance(values, str) else ():
+            if isinstance(v, (IFD, Blob)):
+                self.children.append(v)
+        return self
+
+    def preview(self, width, height, size, compression=7, subfiletype=1):
+        """Makes this IFD describe a jpeg preview"""
+        data = Blob(jpeg(size, width, height))
+        self.add(NewSubFileType, Tag.LONG, subfiletype)
+        self.add(Tag.ImageWidth, Tag.LONG, width)
+        self.add(Tag.ImageLength, Tag.LONG, height)
+        self.add(Tag.Compression, Tag.SHORT, compression)
+        self.add(Tag.StripOffsets, Tag.LONG, data)
+        self.add(Tag.StripByteCounts, Tag.LONG, len(data.data))
+        return self
+
+    def values_of(self, type, values, e):
+        if type in (Tag.ASCII, Tag.UNDEFINED):
+            return values + ('\0' if type == Tag.ASCII else '')
+        values = [v.offset if isinstance(v, (IFD, Blob)) else v
+                  for v in values]
+        if type == Tag.RATIONAL:
+            return ''.join(pack(e + 'LL', n, 1) for n in values)
+        fmt = {Tag.BYTE: 'B', Tag.SHORT: 'H', Tag.LONG: 'L'}[type]
+        return pack(e + fmt * len(values), *values)
+
+    def size(self, e):
+        n = 2 + 12 * len(self.entries) + 4
+        for type, values in self.entries.itervalues():
+            length = len(self.values_of(type, values, e)) \
+                if type not in (Tag.LONG,) else 4 * len(values)
+            if length > 4:
+                n += length + length % 2
+        return n
+
+    def write(self, e):
+        extra = self.offset + 2 + 12 * len(self.entries) + 4
+        head = [pack(e + 'H', len(self.entries))]
+        tail = []
+        for tag in sorted(self.entries):
+            (type, values) = self.entries[tag]
+            data = self.values_of(type, values, e)
+            count = len(data) if type in (Tag.ASCII, Tag.UNDEFINED, Tag.BYTE) \
+                else len(values)
+            if len(data) <= 4:
+                head.append(pack(e + 'HHL', tag, type, count) +
+                            data.ljust(4, '\0'))
+            else:
+                head.append(pack(e + 'HHLL', tag, type, count, extra))
+                data += '\0' * (len(data) % 2)
+                tail.append(data)
+                extra += len(data)
+        head.append(pack(e + 'L', self.next.offset if self.next else 0))
+        return ''.join(head + tail)
+
+
+def tiff(root, endian='<', magic=42):
+    """The bytes of a tiff file with root as the first IFD"""
+    e = endian
+    ifds = []
+    blobs = []
+
+    def walk(ifd):
+        while ifd and ifd not in ifds:
+            ifds.append(ifd)
+            for child in ifd.children:
+                if isinstance(child, IFD):
+                    walk(child)
+                elif child not in blobs:
+                    blobs.append(child)
+            ifd = ifd.next
+    walk(root)
+
+    offset = 8
+    for ifd in ifds:
+        ifd.offset = offset
+        offset += ifd.size(e)
+    for blob in blobs:
+        blob.offset = offset
+        offset += len(blob.data)
+
+    res = [('II' if e == '<' else 'MM') + pack(e + 'HL', magic, 8)]
+    res += [ifd.write(e) for ifd in ifds]
+    res += [blob.data for blob in blobs]
+    return ''.join(res)
+
+
+def exif_ifd():
+    return IFD().add(33434, Tag.RATIONAL, [125]) \
+        .add(36867, Tag.ASCII, "2016:01:01 12:00:00") \
+        .add(Tag.PixelXDimension, Tag.LONG, 6000) \
+        .add(Tag.PixelYDimension, Tag.LONG, 4000)
+
+
+def dng(sizes=SIZES, endian='<', ifds=1, depth=1, exif=True, orientation=6,
+        tags=20):
+    """A DNG with the smallest preview in IFD0 and the rest in SubIFDs.
+
+    depth nests each SubIFD under the previous one. ifds chains that many
+    extra IFDs after IFD0, and tags adds that many private tags to IFD0"""
+    (width, height, size) = sizes[0]
+    root = IFD().preview(width, height, size)
+    root.add(DNGVersion, Tag.BYTE, [1, 4, 0, 0])
+    root.add(Tag.Make, Tag.ASCII, "Synthetic")
+    root.add(Tag.Model, Tag.ASCII, "synthdng")
+    root.add(Tag.Orientation, Tag.SHORT, orientation)
+    for n in range(tags):
+        root.add(50000 + n, Tag.LONG, [n] * (1 + n % 3))
+    if exif:
+        root.add(Tag.ExifTag, Tag.LONG, exif_ifd())
+
+    parent = root
+    subifds = [IFD().preview(w, h, s) for (w, h, s) in sizes[1:]]
+    raw = IFD().add(NewSubFileType, Tag.LONG, 0) \
+        .add(Tag.ImageWidth, Tag.LONG, 6000) \
+        .add(Tag.ImageLength, Tag.LONG, 4000) \
+        .add(Tag.Compression, Tag.SHORT, 1)
+    subifds.append(raw)
+    if depth > 1:
+        for ifd in subifds:
+            parent.add(Tag.SubIFD, Tag.LONG, [ifd])
+            parent = ifd
+    elif subifds:
+        root.add(Tag.SubIFD, Tag.LONG, subifds)
+
+    last = root
+    for n in range(ifds - 1):
+        last.next = IFD().add(NewSubFileType, Tag.LONG, 2) \
+            .add(Tag.ImageWidth, Tag.LONG, 16) \
+            .add(Tag.ImageLength, Tag.LONG, 16)
+        last = last.next
+    return tiff(root, endian)
+
+
+def rw2(size=2 * 1024 * 1024, thumbnail=8 * 1024, endian='<', jfif=False,
+        orientation=8):
+    """A RW2 with a PreviewImage jpeg whose exif holds a thumbnail. With
+    jfif an APP0 segment comes before the exif, as some cameras write"""
+    thumb = IFD().add(Tag.ImageWidth, Tag.LONG, 160) \
+        .add(Tag.ImageLength, Tag.LONG, 120) \
+        .add(Tag.Compression, Tag.SHORT, 6)
+    data = Blob(jpeg(thumbnail, 160, 120))
+    thumb.add(Tag.JPEGInterchangeFormat, Tag.LONG, data)
+    thumb.add(Tag.JPEGInterchangeFormatLength, Tag.LONG, len(data.data))
+    ifd0 = IFD().add(Tag.Orientation, Tag.SHORT, orientation)
+    ifd0.next = thumb
+    app1 = 'Exif\0\0' + tiff(ifd0, endian)
+    head = '\xff\xd8'
+    if jfif:
+        head += '\xff\xe0' + pack('>H', 16) + 'JFIF\0\x01\x01\0\0\x01\0\x01\0\0'
+    head += '\xff\xe1' + pack('>H', len(app1) + 2) + app1
+    preview = head + jpeg(size - len(head) + 2, 1920, 1440)[2:]
+
+    root = IFD().add(Tag.PreviewImage, Tag.UNDEFINED, preview) \
+        .add(Tag.Orientation, Tag.SHORT, 1)
+    return tiff(root, endian, magic=85)
+
+
+def corpus(directory, files=100, seed=0, **kwargs):
+    """Writes files raw files to directory, mixing DNG and RW2 files of both
+    endiannesses. kwargs go to dng(). Returns their paths"""
+    r = random.Random(seed)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass
+    paths = []
+    for n in range(files):
+        endian = r.choice('<>')
+        if n % 4 == 3:
+            path = os.path.join(directory, "P%04d.rw2" % n)
+            data = rw2(endian=endian, jfif=r.random() < 0.5)
+        else:
+            path = os.path.join(directory, "IMG_%04d.dng" % n)
+            data = dng(endian=endian, **kwargs)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Write a corpus of synthetic DNG and RW2 files")
+    parser.add_argument("directory", help="Where to write the files")
+    parser.add_argument("-n", "--files", type=int, default=100)
+    parser.add_argument("--ifds", type=int, default=1,
+                        help="IFDs chained after IFD0 of each DNG, plus one")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="Nest the SubIFDs this deep when over 1")
+    parser.add_argument("--tags", type=int, default=20,
+                        help="Private tags added to IFD0")
+    parser.add_argument("--no-exif", action='store_true',
+                        help="Leave out the exif IFD")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus(args.directory, args.files, seed=args.seed, ifds=args.ifds,
+           depth=args.depth, tags=args.tags, exif=not args.no_exif)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# System calls that the os module of python 2 does not expose
+from ctypes import CDLL, POINTER, byref, c_int, c_uint, c_uint32, c_char_p, \
+    c_size_t, c_ssize_t, c_longlong, c_void_p, create_string_buffer, get_errno
+from ctypes.util import find_library
+import errno
+import os
+
+_libc = CDLL(find_library('c'), use_errno=True)
+
+_libc.pread64.argtypes = [c_int, c_void_p, c_size_t, c_longlong]
+_libc.pread64.restype = c_ssize_t
+_libc.pwrite64.argtypes = [c_int, c_char_p, c_size_t, c_longlong]
+_libc.pwrite64.restype = c_ssize_t
+
+
+def _oserror():
+    e = get_errno()
+    return OSError(e, os.strerror(e))
+
+
+def _pread(fd, length, offset):
+    buf = create_string_buffer(length)
+    res = _libc.pread64(fd, buf, length, offset)
+    if res < 0:
+        raise _oserror()
+    return buf.raw[:res]
+
+
+def _pwrite(fd, data, offset):
+    res = _libc.pwrite64(fd, data, len(data), offset)
+    if res < 0:
+        raise _oserror()
+    return res
+
+
+# They do not move the file position, so it is safe to share the fd between
+# threads
+pread = getattr(os, 'pread', _pread)
+pwrite = getattr(os, 'pwrite', _pwrite)
+
+
+# Copies between files without the data going through user space
+_libc.sendfile64.argtypes = [c_int, c_int, POINTER(c_longlong), c_size_t]
+_libc.sendfile64.restype = c_ssize_t
+try:
+    _libc.copy_file_range.argtypes = [c_int, POINTER(c_longlong), c_int,
+                                      POINTER(c_longlong), c_size_t, c_uint]
+    _libc.copy_file_range.restype = c_ssize_t
+except AttributeError:
+    pass  # glibc older than 2.27
+
+
+def _copy_file_range(src, dst, count, offset_src=None, offset_dst=None):
+    if not hasattr(_libc, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    off_src = None if offset_src is None else byref(c_longlong(offset_src))
+    off_dst = None if offset_dst is None else byref(c_longlong(offset_dst))
+    res = _libc.copy_file_range(src, off_src, dst, off_dst, count, 0)
+    if res < 0:
+        raise _oserror()
+    return res
+
+
+def _sendfile(out_fd, in_fd, offset, count):
+    res = _libc.sendfile64(out_fd, in_fd, byref(c_longlong(offset)), count)
+    if res < 0:
+        raise _oserror()
+    return res
+
+
+copy_file_range = getattr(os, 'copy_file_range', _copy_file_range)
+sendfile = getattr(os, 'sendfile', _sendfile)
+
+# The kernel or the filesystems can not copy between these files
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+_CHUNK = 1024 * 1024
+
+
+def copy_range(src, dst, offset, length):
+    """Copies length bytes at offset of src to the current position of dst.
+    Uses copy_file_range, then sendfile, then reads and writes in chunks,
+    so memory use does not depend on length. Returns the bytes copied,
+    fewer than length if src ends before"""
+    copies = (
+        lambda o, n: copy_file_range(src, dst, n, o),
+        lambda o, n: sendfile(dst, src, o, n),
+        lambda o, n: os.write(dst, pread(src, min(n, _CHUNK), o)),
+    )
+    done = 0
+    for copy in copies:
+        try:
+            while done < length:
+                n = copy(offset + done, min(length - done, 2**30))
+                if not n:
+                    return done  # End of src
+                done += n
+            return done
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copy is copies[-1]:
+                raise
+    return done
+
+
+# inotify
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+
+try:
+    _libc.inotify_init1.argtypes = [c_int]
+    _libc.inotify_add_watch.argtypes = [c_int, c_char_p, c_uint32]
+    _libc.inotify_rm_watch.argtypes = [c_int, c_int]
+except AttributeError:
+    pass  # Not linux
+
+
+def inotify_init():
+    fd = _libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise _oserror()
+    return fd
+
+
+def inotify_add_watch(fd, path, mask):
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    wd = _libc.inotify_add_watch(fd, path, mask)
+    if wd < 0:
+        raise _oserror()
+    return wd
+
+
+def inotify_rm_watch(fd, wd):
+    if _libc.inotify_rm_watch(fd, wd) < 0:
+        raise _oserror()
@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests over a synthetic corpus. Run with python -m unittest test_raw2jpeg
+
+Those that need Raw2Jpeg are skipped where libfuse is not installed."""
+from os.path import join
+import errno
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from attrcache import AttrCache
+import DNG
+from DNG import logging
+import previewcache
+from prefetch import Prefetcher
+from stats import stats
+import synthdng
+from tracing import Tracer
+try:
+    import Raw2Jpeg
+except EnvironmentError:
+    Raw2Jpeg = None  # libfuse is not installed
+
+logging.basicConfig(level=logging.CRITICAL)
+needs_fuse = unittest.skipIf(Raw2Jpeg is None, "libfuse is not installed")
+
+
+class CacheTestCase(unittest.TestCase):
+    """Gives each test a corpus of files raw files in self.raw and an empty
+    preview cache"""
+
+    files = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="raw2jpeg-test")
+        self.raw = join(self.directory, "raw")
+        self.paths = synthdng.corpus(self.raw, self.files)
+        previewcache.set_thumbdir(join(self.directory, "cache"))
+
+    def tearDown(self):
+        previewcache.close()
+        shutil.rmtree(self.directory, True)
+
+
+class TestPreviews(unittest.TestCase):
+    # The largest preview is in IFD0, before the smaller ones in SubIFDs
+    SIZES = ((6000, 4000, 300000), (160, 120, 5000), (1024, 768, 50000))
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix=".dng")
+        with os.fdopen(fd, "wb") as f:
+            f.write(synthdng.dng(self.SIZES, exif=True))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_sorted_by_size_with_an_exif_ifd(self):
+        # The exif IFD has no dimensions. Sorting used to give up on it
+        # and leave the previews in file order
+        with DNG.DNG(self.path) as dng:
+            self.assertEqual([i.StripByteCounts
+                              for i in dng.get_jpeg_previews()],
+                             [5000, 50000, 300000])
+            self.assertEqual(dng.get_jpeg_extent(0)[1], 5000)
+            self.assertEqual(dng.get_jpeg_extent(-1)[1], 300000)
+        with DNG.Preview(self.path) as img:
+            self.assertEqual([p[1] for p in img.layout()['previews']],
+                             [5000, 50000, 300000])
+            self.assertEqual(len(img.read_jpeg_preview(0)), 5000)
+            self.assertEqual(len(img.read_jpeg_preview(-1)), 300000)
+
+    def test_pick_preview(self):
+        with DNG.Preview(self.path) as img:
+            layout = img.layout()
+        for (size, length) in ((0, 5000), (160, 5000), (161, 50000),
+                               (1024, 50000), (1920, 300000),
+                               (10000, 300000), (None, 300000)):
+            self.assertEqual(previewcache.pick_preview(layout, size)[1],
+                             length)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_new_directory_replaces_queued_work(self):
+        built = []
+        prefetcher = Prefetcher(built.append, workers=1, max_queue=10)
+        prefetcher.prefetch("/a", ["/a/%d" % n for n in range(10)])
+        prefetcher.prefetch("/b", ["/b/%d" % n for n in range(5)])
+        self.assertEqual(prefetcher.queue.qsize(), 5)
+        prefetcher.start()
+        prefetcher.queue.join()
+        self.assertEqual(built, ["/b/%d" % n for n in range(5)])
+
+    def test_cancel(self):
+        built = []
+        prefetcher = Prefetcher(built.append, workers=1)
+        prefetcher.prefetch("/a", ["/a/0", "/a/1"])
+        prefetcher.cancel()
+        prefetcher.start()
+        prefetcher.queue.join()
+        self.assertEqual(built, [])
+        # The same directory can be prefetched again
+        prefetcher.prefetch("/a", ["/a/0"])
+        prefetcher.queue.join()
+        self.assertEqual(built, ["/a/0"])
+
+
+class TestTracer(unittest.TestCase):
+    def test_sampling(self):
+        tracer = Tracer(sample={'read': 10})
+
+        def read(n):
+            if n == 3:
+                raise IOError("failed")
+            return n
+        for n in range(100):
+            try:
+                tracer.run('read', read, (n,))
+            except IOError:
+                pass
+        tracer.run('open', read, (0,))
+        # Every call is timed, only a tenth of the reads and the failed one
+        # are kept
+        histograms = tracer.stats()
+        self.assertEqual(histograms['read']['count'], 100)
+        self.assertEqual(histograms['open']['count'], 1)
+        ring = [(op, args, error) for (start, op, args, elapsed, error)
+                in tracer.ring]
+        self.assertEqual([args for (op, args, error) in ring],
+                         [(3,)] + [(n,) for n in range(9, 100, 10)] + [(0,)])
+        self.assertTrue(isinstance(ring[0][2], IOError))
+        self.assertEqual(ring[-1], ('open', (0,), None))
+
+    def test_ring_is_bounded(self):
+        tracer = Tracer(size=5)
+        for n in range(10):
+            tracer.run('getattr', abs, (n,))
+        self.assertEqual([r[2] for r in tracer.ring],
+                         [(n,) for n in range(5, 10)])
+
+
+class TestAttrCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="raw2jpeg-test")
+        self.cache = AttrCache()
+        if not self.cache.inotify:
+            self.skipTest("inotify is not available")
+        self.cache.start()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def invalidated(self, key, timeout=2.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.cache.get(key) is None:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def check(self, name):
+        # A directory of its own, so it is only watched from now on and the
+        # events of writing the file are not seen
+        directory = tempfile.mkdtemp(dir=self.directory)
+        source = join(directory.decode('utf-8'), name) \
+            if isinstance(name, unicode) else join(directory, name)
+        # fusepy gives the paths as unicode
+        path = source.encode('utf-8') if isinstance(source, unicode) \
+            else source
+        with open(path, "w") as f:
+            f.write("a")
+        mtime = os.path.getmtime(path)
+        self.cache.set(('attr', source), source, mtime, {'st_mtime': mtime})
+        self.assertTrue(self.cache.get(('attr', source)))
+        with open(path, "a") as f:
+            f.write("b")
+        self.assertTrue(self.invalidated(('attr', source)))
+
+    def test_non_ascii_names(self):
+        self.check(u'caf\xe9.dng')
+        self.check('caf\xc3\xa9.dng')
+
+    def test_names_that_are_not_utf8(self):
+        self.check('\xff.dng')
+        # The reader is still alive
+        self.check('b.dng')
+
+    def cached(self, path):
+        mtime = os.path.getmtime(path)
+        self.cache.set(('attr', path), path, mtime, {'st_mtime': mtime})
+        self.assertTrue(self.cache.get(('attr', path)))
+
+    def test_renamed_directory(self):
+        album = tempfile.mkdtemp(dir=self.directory)
+        os.mkdir(join(album, "sub"))
+        paths = [join(album, "a.dng"), join(album, "sub", "b.dng")]
+        for path in paths:
+            open(path, "w").close()
+            self.cached(path)
+        renamed = album + "-renamed"
+        os.rename(album, renamed)
+        for path in paths:
+            self.assertTrue(self.invalidated(('attr', path)))
+        # The new names are watched again
+        moved = join(renamed, "sub", "b.dng")
+        self.cached(moved)
+        with open(moved, "a") as f:
+            f.write("b")
+        self.assertTrue(self.invalidated(('attr', moved)))
+
+    def test_deleted_directory(self):
+        album = tempfile.mkdtemp(dir=self.directory)
+        path = join(album, "a.dng")
+        open(path, "w").close()
+        self.cached(path)
+        self.cached(album)
+        shutil.rmtree(album)
+        self.assertTrue(self.invalidated(('attr', path)))
+        self.assertTrue(self.invalidated(('attr', album)))
+
+
+class TestPreviewCache(CacheTestCase):
+    def test_renamed_file_keeps_its_preview(self):
+        preview = previewcache.get_preview(self.paths[0])
+        renamed = join(self.raw, "renamed.dng")
+        os.rename(self.paths[0], renamed)
+        builds = stats.counters.get('preview_builds', 0)
+        self.assertEqual(previewcache.get_preview(renamed), preview)
+        self.assertEqual(stats.counters.get('preview_builds', 0), builds)
+
+    def test_changed_file_replaces_its_preview(self):
+        path = self.paths[0]
+        preview = previewcache.get_preview(path)
+        thumbnail = previewcache.get_preview(path, 0)
+        with open(path, "r+b") as f:
+            f.seek(0, 2)
+            f.write("\0")
+        new = previewcache.get_preview(path)
+        self.assertNotEqual(new, preview)
+        self.assertTrue(os.path.exists(new))
+        self.assertFalse(os.path.exists(preview))
+        self.assertNotIn(preview, previewcache.orientations.d)
+        # Other sizes are replaced when they are built again
+        self.assertTrue(os.path.exists(thumbnail))
+
+    def concurrent_previews(self, path, threads=8):
+        """What each of threads calling get_preview(path) at the same time
+        gets, with the builds slowed down so that they overlap"""
+        results = []
+        (build_preview, read_layout) = (previewcache.build_preview,
+                                        previewcache.read_layout)
+
+        def slow_build(*args):
+            time.sleep(0.2)
+            return build_preview(*args)
+
+        def slow_layout(*args):
+            time.sleep(0.2)
+            return read_layout(*args)
+
+        def client():
+            try:
+                results.append(previewcache.get_preview(path))
+            except previewcache.PreviewError as e:
+                results.append(e)
+        previewcache.build_preview = slow_build
+        previewcache.read_layout = slow_layout
+        try:
+            clients = [threading.Thread(target=client)
+                       for n in range(threads)]
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+        finally:
+            previewcache.build_preview = build_preview
+            previewcache.read_layout = read_layout
+        return results
+
+    def test_built_once_under_concurrent_calls(self):
+        builds = stats.counters.get('preview_builds', 0)
+        results = self.concurrent_previews(self.paths[0])
+        self.assertEqual(stats.counters.get('preview_builds', 0), builds + 1)
+        self.assertEqual(len(results), 8)
+        self.assertEqual(set(results), set([results[0]]))
+        self.assertTrue(previewcache.is_built(results[0]))
+
+    def test_failed_once_under_concurrent_calls(self):
+        path = join(self.raw, "bad.dng")
+        with open(path, "w") as f:
+            f.write("not a raw file")
+        failures = stats.counters.get('build_failures', 0)
+        results = self.concurrent_previews(path)
+        self.assertEqual(stats.counters.get('build_failures', 0),
+                         failures + 1)
+        self.assertEqual(len(results), 8)
+        # The waiters get the error of the build they waited for
+        self.assertTrue(isinstance(results[0], previewcache.PreviewError))
+        self.assertEqual(set(id(r) for r in results), set([id(results[0])]))
+
+    def test_sweeps_temp_files_of_dead_processes(self):
+        preview = previewcache.get_preview(self.paths[0])
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        left = previewcache.temp_path(preview, dead.pid)
+        building = previewcache.temp_path(preview)
+        for path in (left, building):
+            open(path, "w").close()
+        previewcache.sweep_temp_files()
+        self.assertFalse(os.path.exists(left))
+        self.assertTrue(os.path.exists(building))
+        self.assertTrue(os.path.exists(preview))
+
+
+class FullDisk(object):
+    """A journal file that fails to write while full is set"""
+
+    def __init__(self, f):
+        self.f = f
+        self.full = True
+
+    def write(self, data):
+        if self.full:
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        self.f.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.f, attr)
+
+
+class TestJournalStore(CacheTestCase):
+    def reopen(self):
+        previewcache.close()
+        previewcache.set_thumbdir(join(self.directory, "cache"))
+        return previewcache.orientations
+
+    def test_replay(self):
+        store = previewcache.orientations
+        store.set("/a", 6)
+        store.set("/b", 3)
+        store.remove("/b")
+        store = self.reopen()
+        self.assertEqual(store.d, {"/a": 6})
+        # Over a snapshot, and after a line cut short by a crash
+        store.flush()
+        store.compact()
+        store.set("/c", 8)
+        store.close()
+        with open(store.journalname, "a") as f:
+            f.write('["/d", ')
+        store = self.reopen()
+        self.assertEqual(store.d, {"/a": 6, "/c": 8})
+
+    def test_full_disk(self):
+        store = previewcache.orientations
+        journal = store.journal = FullDisk(store.journal)
+        store.set("/a", 6)
+        self.assertRaises(IOError, store.flush)
+        store.set("/b", 3)
+        self.assertEqual(store.pending, [("/a", 6), ("/b", 3)])
+        # The writer fails too, and goes on
+        with store.lock:
+            store.wakeup.notify()
+        time.sleep(0.1)
+        self.assertTrue(store.writer.is_alive())
+        journal.full = False
+        store = self.reopen()
+        self.assertEqual(store.d, {"/a": 6, "/b": 3})
+
+
+class TestBuildPool(CacheTestCase):
+    def setUp(self):
+        super(TestBuildPool, self).setUp()
+        previewcache.set_build_workers(1, 0.5)
+        self.pool = previewcache.build_pool
+
+    def tearDown(self):
+        previewcache.build_pool = None
+        while not self.pool.idle.empty():
+            (process, conn) = self.pool.idle.get()
+            process.terminate()
+            process.join()
+        super(TestBuildPool, self).tearDown()
+
+    def test_builds_and_keeps_the_layout(self):
+        path = self.paths[0]
+        preview = previewcache.get_preview(path)
+        self.assertTrue(previewcache.is_built(preview))
+        self.assertTrue(previewcache.layouts.get(path, os.stat(path)))
+
+    def test_hanging_header_is_blacklisted(self):
+        # Opening a fifo without a writer blocks until the build times out
+        fifo = join(self.raw, "hang.dng")
+        os.mkfifo(fifo)
+        self.assertRaises(previewcache.PreviewError,
+                          previewcache.get_preview, fifo)
+        self.assertTrue(previewcache.blacklist.match(
+            fifo, os.path.getmtime(fifo)))
+        # The process was replaced
+        self.assertTrue(previewcache.get_preview(self.paths[0]))
+
+    @needs_fuse
+    def test_hanging_header_in_getattr_and_listing(self):
+        os.mkfifo(join(self.raw, "a.dng"))
+        os.mkfifo(join(self.raw, "b.dng"))
+        fs = Raw2Jpeg.Raw2Jpeg(self.raw)
+        start = time.time()
+        fs('getattr', '/a.dng' + fs.MASK, None)
+        self.assertLess(time.time() - start, 2)
+        # b.dng is parsed for the first time by the listing
+        listing = list(fs('readdir', '/', 0))
+        self.assertLess(time.time() - start, 3)
+        self.assertNotIn('a.dng' + fs.MASK, [e[0] for e in listing])
+        for name in ("a.dng", "b.dng"):
+            self.assertTrue(previewcache.blacklist.match(join(self.raw,
+                                                              name)))
+        names = [e[0] for e in fs('readdir', '/', 0)]
+        self.assertNotIn('b.dng' + fs.MASK, names)
+        self.assertIn(os.path.basename(self.paths[0]) + fs.MASK, names)
+
+    def test_busy_pool(self):
+        worker = self.pool.idle.get()
+        try:
+            self.assertRaises(previewcache.BuildPoolBusy,
+                              previewcache.get_preview, self.paths[0])
+        finally:
+            self.pool.idle.put(worker)
+        self.assertFalse(previewcache.blacklist.match(self.paths[0]))
+        self.assertTrue(previewcache.get_preview(self.paths[0]))
+
+
+@needs_fuse
+class TestPrewarm(CacheTestCase):
+    def test_builds_every_preview(self):
+        Raw2Jpeg.prewarm(self.raw, jobs=2)
+        for path in self.paths:
+            for size in (None, 0):
+                self.assertTrue(previewcache.is_built(
+                    previewcache.preview_path(path, size)))
+
+    def test_empty_tree(self):
+        shutil.rmtree(self.raw)
+        os.mkdir(self.raw)
+        Raw2Jpeg.prewarm(self.raw, jobs=1)
+
+
+@needs_fuse
+class TestRaw2Jpeg(CacheTestCase):
+    def test_broken_file_leaves_the_listing(self):
+        for attr_cache in (0, 100):
+            name = "bad%d.dng" % attr_cache
+            with open(join(self.raw, name), "w") as f:
+                f.write("not a raw file")
+            fs = Raw2Jpeg.Raw2Jpeg(self.raw, attr_cache=attr_cache)
+            names = [e[0] for e in fs('readdir', '/', 0)]
+            self.assertIn(name + fs.MASK, names)
+            records = len(previewcache.blacklist.pending)
+            for n in range(2):
+                names = [e[0] for e in fs('readdir', '/', 0)]
+                self.assertNotIn(name + fs.MASK, names)
+            self.assertEqual(len(previewcache.blacklist.pending), records)
+
+    def test_extents(self):
+        fs = Raw2Jpeg.Raw2Jpeg(self.raw, extents=True)
+        for orig in self.paths:
+            with DNG.Preview(orig) as img:
+                preview = str(img.read_jpeg_preview(-1))
+            size = len(preview)
+            path = "/" + os.path.basename(orig) + fs.MASK
+            self.assertEqual(fs('getattr', path, None)['st_size'], size)
+            fh = fs('open', path, os.O_RDONLY)
+            try:
+                for (offset, length) in ((0, 4096), (size // 2, 4096),
+                                         (size - 10, 4096), (size, 4096),
+                                         (size + 100, 4096), (0, size)):
+                    expected = preview[offset:offset + length]
+                    self.assertEqual(fs('read', path, length, offset, fh),
+                                     expected)
+                    (fd, start, count) = fs('read_buf', path, length,
+                                            offset, fh)
+                    self.assertEqual(count, len(expected))
+                    self.assertEqual(Raw2Jpeg.pread(fd, count, start),
+                                     expected)
+            finally:
+                fs('release', path, fh)
+
+    def test_served_is_bounded(self):
+        fs = Raw2Jpeg.Raw2Jpeg(self.raw)
+        fs.SERVED_SIZE = 2
+        paths = ["/" + os.path.basename(p) + fs.MASK for p in self.paths]
+        for (path, orig) in zip(paths, self.paths):
+            self.assertFalse(fs._unchanged(path, orig))
+        self.assertEqual(fs.served.keys(), paths[-2:])
+        # The one opened last is still known, the first one was forgotten
+        self.assertTrue(fs._unchanged(paths[-1], self.paths[-1]))
+        self.assertFalse(fs._unchanged(paths[0], self.paths[0]))
+
+    def test_variants(self):
+        fs = Raw2Jpeg.Raw2Jpeg(self.raw, variants=('thumb', '1000', 'full'))
+        dng = os.path.basename(self.paths[0])
+        listed = dict((e[0], e[1]) for e in fs.readdir('/', 0)
+                      if isinstance(e, tuple) and e[0].startswith(dng))
+        self.assertEqual(sorted(listed), [dng + s for s in (
+            '.1000.jpg', '.full.jpg', fs.MASK, '.thumb.jpg')])
+        layout = previewcache.get_layout(self.paths[0])
+        # Each variant is a different preview of the corpus
+        self.assertEqual(len(set(previewcache.pick_preview(layout, size)[1]
+                                 for size in (0, 1000, None))), 3)
+        for (suffix, size) in (('.thumb.jpg', 0), ('.1000.jpg', 1000),
+                               ('.full.jpg', None), (fs.MASK, None)):
+            length = previewcache.pick_preview(layout, size)[1]
+            path = '/' + dng + suffix
+            self.assertEqual(listed[dng + suffix]['st_size'], length)
+            fh = fs.open(path, os.O_RDONLY)
+            try:
+                self.assertEqual(len(fs.read(path, length + 1, 0, fh)),
+                                 length)
+            finally:
+                fs.release(path, fh)
+
+
+@needs_fuse
+class TestLoadgen(CacheTestCase):
+    def test_import_keeps_the_cache(self):
+        import loadgen
+        self.assertEqual(previewcache.get_thumbdir(),
+                         join(self.directory, "cache"))
+
+    def test_record_and_replay(self):
+        import loadgen
+        trace = join(self.directory, "trace")
+        fs = loadgen.RecordingRaw2Jpeg(self.raw)
+        fs.start_recording(trace)
+        names = [e[0] for e in fs('readdir', '/', 0)
+                 if e[0].endswith(fs.MASK)]
+        path = '/' + names[0]
+        fh = fs('open', path, os.O_RDONLY)
+        self.assertTrue(fs('read', path, 4096, 0, fh))
+        fs('release', path, fh)
+        fs.stop_recording()
+        fs('getattr', path, None)  # Not recorded
+
+        records = loadgen.load_trace(trace)
+        self.assertEqual([r['op'] for r in records],
+                         ['readdir', 'open', 'read', 'release'])
+        res = loadgen.Replay(fs, records).run(clients=2)
+        self.assertEqual(res['skipped'], 0)
+        self.assertFalse(any(r['errors']
+                             for r in res['operations'].itervalues()))
+
+    def test_replay_read_buf(self):
+        # What a live mount calls instead of read
+        import loadgen
+        fs = Raw2Jpeg.Raw2Jpeg(self.raw)
+        path = "/" + os.path.basename(self.paths[0]) + fs.MASK
+        size = fs('getattr', path, None)['st_size']
+        trace = [{'op': 'open', 'args': [path, os.O_RDONLY], 'fh': 1},
+                 {'op': 'read_buf', 'args': [path, 4096, 0, 1]},
+                 {'op': 'read_buf', 'args': [path, 4096, size - 100, 1]},
+                 {'op': 'release', 'args': [path, 1]}]
+        data = []
+
+        class Replay(loadgen.Replay):
+            def call(self, op, args):
+                data.append(loadgen.Replay.call(self, op, args))
+                return data[-1]
+        Replay(fs, trace).run()
+        with open(previewcache.get_preview(self.paths[0]), "rb") as f:
+            preview = f.read()
+        self.assertEqual(data[1], preview[:4096])
+        self.assertEqual(data[2], preview[-100:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import deque
+import fcntl
+import os
+import signal
+import threading
+import time
+
+from DNG import logging
+
+
+class Histogram(object):
+    """Counts of durations in power of two buckets of microseconds. Bucket
+    n holds the durations under 2**n us, and over the previous bucket"""
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        n = min(int(seconds * 1000000).bit_length(), self.BUCKETS - 1)
+        self.counts[n] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        """Upper bound in seconds of the duration of the q fraction of the
+        calls, or None if there were none"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for n, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return 2 ** n / 1000000.0
+        return 2 ** (self.BUCKETS - 1) / 1000000.0
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'buckets': dict((2 ** n / 1000000.0, c)
+                                for n, c in enumerate(self.counts) if c)}
+
+
+class Tracer(object):
+    """Times every call and keeps a sample of them in a ring buffer.
+
+    Every call goes into the latency histogram of its operation, while only
+    one in sample[op] calls, and every failed one, is kept in the ring.
+    Records keep the raw arguments and are only formatted when dumped, so
+    tracing costs no string formatting on the hot path."""
+
+    def __init__(self, size=10000, sample=None):
+        self.ring = deque(maxlen=size)
+        self.sample = sample or {}  # op -> keep one call in this many
+        self.lock = threading.Lock()
+        self.histograms = {}  # op -> Histogram
+        self.calls = {}  # op -> number of calls
+
+    def run(self, op, f, args):
+        start = time.time()
+        error = None
+        try:
+            return f(*args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(op, args, start, time.time() - start, error)
+
+    def record(self, op, args, start, elapsed, error=None):
+        with self.lock:
+            histogram = self.histograms.get(op)
+            if histogram is None:
+                histogram = self.histograms[op] = Histogram()
+            histogram.add(elapsed)
+            n = self.calls[op] = self.calls.get(op, 0) + 1
+        if error is not None or n % self.sample.get(op, 1) == 0:
+            # File info structures are freed by libfuse, keep their handle
+            args = tuple(getattr(a, 'fh', a) for a in args)
+            self.ring.append((start, op, args, elapsed, error))
+
+    def stats(self):
+        """Latency histograms by operation"""
+        with self.lock:
+            return dict((op, h.as_dict())
+                        for op, h in self.histograms.iteritems())
+
+    def format(self):
+        lines = ["# op calls p50 p99 total (seconds)"]
+        for op, h in sorted(self.stats().iteritems()):
+            lines.append("%s %d %s %s %.6f" % (op, h['count'], h['p50'],
+                                               h['p99'], h['total']))
+        lines.append("# start op args elapsed error")
+        for (start, op, args, elapsed, error) in list(self.ring):
+            lines.append("%.6f %s %r %.6f %s" % (start, op, args, elapsed,
+                                                 error or ""))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            f.write(self.format())
+        logging.info("Trace written to %s", path)
+
+    def dump_on_signal(self, path, signum=signal.SIGUSR1):
+        """Writes the trace to path when the process gets signum. Must be
+        called from the main thread.
+
+        Python runs signal handlers in the main thread, which is blocked in
+        libfuse while mounted, so the signal is noticed through the wakeup
+        fd by a thread of its own instead"""
+        (r, w) = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL,
+                    fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signum, lambda signum, frame: None)
+        signal.set_wakeup_fd(w)
+
+        def wait():
+            while True:
+                os.read(r, 1)
+                try:
+                    self.dump(path)
+                except:
+                    logging.warning("Error writing the trace to %s", path)
+
+        t = threading.Thread(target=wait, name="trace dump")
+        t.daemon = True
+        t.start()